@@ -2,6 +2,8 @@
 Global configuration for anticipatory infilling models.
 """
 
+import os
+
 # model hyper-parameters
 
 CONTEXT_SIZE = 1024                # model context
@@ -25,7 +27,7 @@ MAX_INTERARRIVAL_IN_SECONDS = 10   # maximum interarrival time (for MIDI-like en
 
 # preprocessing settings
 
-PREPROC_WORKERS = 16
+PREPROC_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
 
 COMPOUND_SIZE = 5                  # event size in the intermediate compound tokenization
 MAX_TRACK_INSTR = 16               # exclude tracks with large numbers of instruments
@@ -2,17 +2,61 @@
 Utilities for converting to and from Midi data and encoded/tokenized data.
 """
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import mido
+import numpy as np
 
+from anticipation import smf
 from anticipation.config import *
 from anticipation.vocab import *
-from anticipation.ops import unpad
 
 
-def midi_to_interarrival(midifile, debug=False, stats=False):
-    midi = mido.MidiFile(midifile)
+def smf_to_interarrival(midi, stats=False):
+    """ midi_to_interarrival for a file parsed by the fast reader (see anticipation.smf) """
+    events = smf.merged_events(midi)
+    instrs = smf.instruments(events)
+
+    notes = (events[:,1] & 0xF0) != smf.PROGRAM_CHANGE
+    events, instrs = events[notes], instrs[notes]
+    onsets = ((events[:,1] & 0xF0) == smf.NOTE_ON) & (events[:,3] > 0)
+
+    dt = np.rint(TIME_RESOLUTION*smf.TempoMap(midi).elapsed(events[:,0])).astype(np.int64)
+    delta_ticks = np.minimum(dt, MAX_INTERARRIVAL-1)
+    truncations = int(np.sum(delta_ticks != dt))
+
+    # a time step event (if time elapsed since the last token) before each note event
+    offsets = np.where(onsets, MIDI_START_OFFSET, MIDI_END_OFFSET)
+    tokens = np.stack([MIDI_TIME_OFFSET + delta_ticks, offsets + (2**7)*instrs + events[:,2]], axis=1)
+    keep = np.ones(tokens.shape, dtype=bool)
+    keep[:,0] = delta_ticks > 0
+    tokens = tokens[keep].tolist()
+
+    if stats:
+        return tokens, truncations
+
+    return tokens
+
+
+def midi_to_interarrival(midifile, debug=False, stats=False, fast=False):
+    """
+    Convert a MIDI file to the interarrival tokenization.
+
+    With fast=True, read the file with the fast reader in anticipation.smf
+    rather than mido (falling back to mido for files that it can't read),
+    which gives the same tokens.
+    """
+
+    if fast and type(midifile) == str and not debug:
+        try:
+            return smf_to_interarrival(smf.read(midifile), stats)
+        except smf.SMFError:
+            pass
+
+    if type(midifile) == str:
+        midi = mido.MidiFile(midifile)
+    else:
+        midi = midifile
 
     tokens = []
     dt = 0
@@ -125,7 +169,53 @@ def interarrival_to_midi(tokens, debug=False):
     return mid
 
 
-def midi_to_compound(midifile, debug=False):
+def smf_to_compound(midi):
+    """ midi_to_compound for a file parsed by the fast reader (see anticipation.smf) """
+    events = smf.merged_events(midi)
+    instrs = smf.instruments(events)
+
+    notes = (events[:,1] & 0xF0) != smf.PROGRAM_CHANGE
+    events, instrs = events[notes], instrs[notes]
+    channels, pitches, velocities = events[:,1] & 0x0F, events[:,2], events[:,3]
+    onsets = ((events[:,1] & 0xF0) == smf.NOTE_ON) & (velocities > 0)
+
+    # each offset closes the earliest open note with the same (instr, note, channel)
+    closes = np.full(len(events), -1)
+    open_notes = defaultdict(deque)
+    keys = zip(instrs.tolist(), pitches.tolist(), channels.tolist())
+    for idx, (key, onset) in enumerate(zip(keys, onsets.tolist())):
+        if onset:
+            open_notes[key].append(idx)
+        elif open_notes[key]:
+            closes[open_notes[key].popleft()] = idx
+
+    # time quantization, in one pass over all the notes
+    tempo_map = smf.TempoMap(midi)
+    seconds = tempo_map.seconds(events[:,0])
+    onsets = np.flatnonzero(onsets)
+    closes = closes[onsets]
+    durations = np.where(closes >= 0, np.rint(TIME_RESOLUTION*(seconds[closes] - seconds[onsets])), -1)
+
+    # Our compound word is: (time, duration, note, instr, velocity)
+    return np.stack([tempo_map.bins(events[onsets,0]), durations.astype(np.int64),
+                     pitches[onsets], instrs[onsets], velocities[onsets]], axis=1).ravel().tolist()
+
+
+def midi_to_compound(midifile, debug=False, fast=False):
+    """
+    Convert a MIDI file to the compound tokenization.
+
+    With fast=True, read the file with the fast reader in anticipation.smf
+    rather than mido (falling back to mido for files that it can't read),
+    which gives the same tokens.
+    """
+
+    if fast and type(midifile) == str and not debug:
+        try:
+            return smf_to_compound(smf.read(midifile))
+        except smf.SMFError:
+            pass
+
     if type(midifile) == str:
         midi = mido.MidiFile(midifile)
     else:
@@ -205,6 +295,27 @@ def midi_to_compound(midifile, debug=False):
     return tokens
 
 
+def midi_to_encodings(filename, fast=False):
+    """
+    Convert a MIDI file to both the compound and the interarrival tokenizations,
+    parsing the file only once.
+
+    Returns the compound tokens, and the interarrival tokens with the number
+    of truncated interarrival times (see midi_to_interarrival).
+    """
+
+    if fast:
+        try:
+            midi = smf.read(filename)
+        except smf.SMFError:
+            pass
+        else:
+            return smf_to_compound(midi), smf_to_interarrival(midi, stats=True)
+
+    midi = mido.MidiFile(filename)
+    return midi_to_compound(midi), midi_to_interarrival(midi, stats=True)
+
+
 def compound_to_midi(tokens, debug=False):
     mid = mido.MidiFile()
     mid.ticks_per_beat = TIME_RESOLUTION // 2 # 2 beats/second at quarter=120
@@ -261,28 +372,22 @@ def compound_to_midi(tokens, debug=False):
 
 def compound_to_events(tokens, stats=False):
     assert len(tokens) % 5 == 0
-    tokens = tokens.copy()
-
-    # remove velocities
-    del tokens[4::5]
+    tokens = np.asarray(tokens, dtype=np.int64).reshape(-1, 5)
+    time, dur, note, instr = tokens[:,0], tokens[:,1], tokens[:,2], tokens[:,3] # remove velocities
 
     # combine (note, instrument)
-    assert all(-1 <= tok < 2**7 for tok in tokens[2::4])
-    assert all(-1 <= tok < 129 for tok in tokens[3::4])
-    tokens[2::4] = [SEPARATOR if note == -1 else MAX_PITCH*instr + note
-                    for note, instr in zip(tokens[2::4],tokens[3::4])]
-    tokens[2::4] = [NOTE_OFFSET + tok for tok in tokens[2::4]]
-    del tokens[3::4]
+    assert ((-1 <= note) & (note < 2**7)).all()
+    assert ((-1 <= instr) & (instr < 129)).all()
+    note = NOTE_OFFSET + np.where(note == -1, SEPARATOR, MAX_PITCH*instr + note)
 
     # max duration cutoff and set unknown durations to 250ms
-    truncations = sum([1 for tok in tokens[1::3] if tok >= MAX_DUR])
-    tokens[1::3] = [TIME_RESOLUTION//4 if tok == -1 else min(tok, MAX_DUR-1)
-                    for tok in tokens[1::3]]
-    tokens[1::3] = [DUR_OFFSET + tok for tok in tokens[1::3]]
+    truncations = int((dur >= MAX_DUR).sum())
+    dur = DUR_OFFSET + np.where(dur == -1, TIME_RESOLUTION//4, np.minimum(dur, MAX_DUR-1))
 
-    assert min(tokens[0::3]) >= 0
-    tokens[0::3] = [TIME_OFFSET + tok for tok in tokens[0::3]]
+    assert time.min() >= 0
+    time = TIME_OFFSET + time
 
+    tokens = np.stack([time, dur, note], axis=1).reshape(-1).tolist()
     assert len(tokens) % 3 == 0
 
     if stats:
@@ -292,47 +397,38 @@ def compound_to_events(tokens, stats=False):
 
 
 def events_to_compound(tokens, debug=False):
-    tokens = unpad(tokens)
+    tokens = np.asarray(tokens, dtype=np.int64).reshape(-1, 3)
+    tokens = tokens[tokens[:,2] != REST] # unpad
+    separators = tokens[:,2] == SEPARATOR
+    assert (tokens[separators] == SEPARATOR).all()
 
     # move all tokens to zero-offset for synthesis
-    tokens = [tok - CONTROL_OFFSET if tok >= CONTROL_OFFSET and tok != SEPARATOR else tok
-              for tok in tokens]
+    tokens = np.where((tokens >= CONTROL_OFFSET) & (tokens != SEPARATOR), tokens - CONTROL_OFFSET, tokens)
 
     # remove type offsets
-    tokens[0::3] = [tok - TIME_OFFSET if tok != SEPARATOR else tok for tok in tokens[0::3]]
-    tokens[1::3] = [tok - DUR_OFFSET if tok != SEPARATOR else tok for tok in tokens[1::3]]
-    tokens[2::3] = [tok - NOTE_OFFSET if tok != SEPARATOR else tok for tok in tokens[2::3]]
-
-    offset = 0 # add max time from previous track for synthesis
-    track_max = 0 # keep track of max time in track
-    for j, (time,dur,note) in enumerate(zip(tokens[0::3],tokens[1::3],tokens[2::3])):
-        if note == SEPARATOR:
-            offset += track_max
-            track_max = 0
-            if debug:
-                print('Sequence Boundary')
-        else:
-            track_max = max(track_max, time+dur)
-            tokens[3*j] += offset
+    tokens = np.where(tokens != SEPARATOR, tokens - [TIME_OFFSET, DUR_OFFSET, NOTE_OFFSET], tokens)
 
-    # strip sequence separators
-    assert len([tok for tok in tokens if tok == SEPARATOR]) % 3 == 0
-    tokens = [tok for tok in tokens if tok != SEPARATOR]
+    # add max time from previous tracks for synthesis
+    if debug:
+        for _ in range(separators.sum()):
+            print('Sequence Boundary')
 
-    assert len(tokens) % 3 == 0
-    out = 5*(len(tokens)//3)*[0]
-    out[0::5] = tokens[0::3]
-    out[1::5] = tokens[1::3]
-    out[2::5] = [tok - (2**7)*(tok//2**7) for tok in tokens[2::3]]
-    out[3::5] = [tok//2**7 for tok in tokens[2::3]]
-    out[4::5] = (len(tokens)//3)*[72] # default velocity
-
-    assert max(out[1::5]) < MAX_DUR
-    assert max(out[2::5]) < MAX_PITCH
-    assert max(out[3::5]) < MAX_INSTR
-    assert all(tok >= 0 for tok in out)
-
-    return out
+    events = tokens[~separators]
+    track = np.cumsum(separators)[~separators]
+    track_max = np.zeros(separators.sum()+1, dtype=np.int64) # max time in each track
+    np.maximum.at(track_max, track, events[:,0] + events[:,1])
+    offset = np.cumsum(track_max) - track_max
+    time, dur, note = events[:,0] + offset[track], events[:,1], events[:,2] # strip sequence separators
+
+    out = np.stack([time, dur, note - (2**7)*(note//2**7), note//2**7,
+                    np.full(len(events), 72)], axis=1) # default velocity
+
+    assert out[:,1].max() < MAX_DUR
+    assert out[:,2].max() < MAX_PITCH
+    assert out[:,3].max() < MAX_INSTR
+    assert (out >= 0).all()
+
+    return out.reshape(-1).tolist()
 
 
 def events_to_midi(tokens, debug=False):
@@ -0,0 +1,443 @@
+"""
+Utilities for reading and writing tokenized datasets.
+
+A tokenized dataset is a sequence of fixed-length records (CONTEXT_SIZE tokens
+each). Datasets are stored either as text (one whitespace-separated record per
+line) or in a binary format: a small header followed by the records, packed at
+a fixed stride. Binary datasets are memory-mapped, so records can be accessed
+at random, as zero-copy views, without parsing.
+
+The intermediate compound tokenization of a MIDI file (see midi_to_compound)
+is stored either as a text file (<midi file>.compound.txt) or in a shard: a
+binary container that concatenates the compound tokens of many tracks, with
+an index keyed by the hash of each MIDI file. Shards can also store the
+other encodings of the tracks (arrival-time events and interarrival tokens),
+together with per-track information such as the filter status of the track.
+"""
+
+import os
+import json
+import struct
+import hashlib
+
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+from anticipation.config import *
+from anticipation.vocab import *
+
+
+MAGIC = b'AMTOKENS'
+HEADER = struct.Struct('<8s8sIQ')  # magic, dtype, record length, record count
+HEADER_SIZE = 32                    # header is padded for alignment of the records
+
+
+def token_dtype(vocab_size=max(VOCAB_SIZE, MIDI_VOCAB_SIZE)):
+    """ the smallest dtype that can store every token in the vocabulary """
+    return np.dtype('<u2') if vocab_size <= 2**16 else np.dtype('<i4')
+
+
+def is_binary(filename):
+    """ check whether a file is a binary tokenized dataset """
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class BinaryWriter:
+    """ write records to a binary tokenized dataset """
+
+    def __init__(self, filename, length=CONTEXT_SIZE, dtype=None):
+        self.length = length
+        self.dtype = token_dtype() if dtype is None else np.dtype(dtype)
+        self.count = 0
+
+        self.file = open(filename, 'wb')
+        self.write_header()
+
+    def write_header(self):
+        header = HEADER.pack(MAGIC, self.dtype.str.encode(), self.length, self.count)
+        self.file.seek(0)
+        self.file.write(header.ljust(HEADER_SIZE, b'\0'))
+
+    def write(self, tokens):
+        assert len(tokens) == self.length
+        self.file.write(np.asarray(tokens, dtype=self.dtype).tobytes())
+        self.count += 1
+
+    def extend(self, records):
+        records = np.asarray(records, dtype=self.dtype).reshape(-1, self.length)
+        self.file.write(records.tobytes())
+        self.count += len(records)
+
+    def close(self):
+        if not self.file.closed:
+            self.write_header() # record the final count
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextWriter:
+    """ write records to a text tokenized dataset (one record per line) """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+
+    def write(self, tokens):
+        self.file.write(' '.join([str(tok) for tok in tokens]) + '\n')
+
+    def extend(self, records):
+        for tokens in np.asarray(records).tolist():
+            self.write(tokens)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def writer(filename, binary=False):
+    return BinaryWriter(filename) if binary else TextWriter(filename)
+
+
+class BinaryDataset:
+    """
+    Memory-mapped binary tokenized dataset.
+
+    Indexing returns a record (or a slice of records) as a NumPy view into the
+    mapped file; tensor returns the same view as a torch tensor. The mapping is
+    copy-on-write: modifying a view never modifies the file.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            magic, dtype, length, count = HEADER.unpack(f.read(HEADER.size))
+
+        assert magic == MAGIC, f'{filename} is not a binary tokenized dataset'
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        self.length = length
+
+        # trust the file size over the header if the writer didn't finish
+        stride = length*self.dtype.itemsize
+        count = min(count, (os.path.getsize(filename) - HEADER_SIZE) // stride)
+
+        self.records = np.memmap(filename, dtype=self.dtype, mode='c',
+                                 offset=HEADER_SIZE, shape=(count, length))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        return self.records[idx]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def tensor(self, idx):
+        return torch.from_numpy(self.records[idx])
+
+    def close(self):
+        # the file is unmapped once no records (views) remain referenced
+        self.records = np.zeros((0, self.length), dtype=self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextDataset:
+    """
+    Text tokenized dataset, with the same interface as BinaryDataset.
+
+    Records are parsed lazily: the file is indexed by line on construction.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.offsets = [0]
+        for line in self.file:
+            self.offsets.append(self.offsets[-1] + len(line))
+
+        self.offsets.pop()
+        self.dtype = token_dtype()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record(self, idx):
+        self.file.seek(self.offsets[idx])
+        return np.array(self.file.readline().split(), dtype=self.dtype)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return np.stack([self.record(i) for i in range(len(self))[idx]])
+
+        return self.record(range(len(self))[idx])
+
+    def __iter__(self):
+        self.file.seek(0)
+        for line in self.file:
+            yield np.array(line.split(), dtype=self.dtype)
+
+    def tensor(self, idx):
+        return torch.from_numpy(self[idx])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load(filename):
+    """ open a tokenized dataset (binary or text) """
+    return BinaryDataset(filename) if is_binary(filename) else TextDataset(filename)
+
+
+COMPOUND_MAGIC = b'AMTCMPND'
+COMPOUND_HEADER = struct.Struct('<8sQQQ') # magic, track count, index offset, index size
+COMPOUND_SHARD = 'compound.bin'           # names of the shards in each dataset directory
+EVENTS_SHARD = 'events.bin'
+INTERARRIVAL_SHARD = 'interarrival.bin'
+
+
+def file_hash(filename):
+    """ the key of a MIDI file in a compound shard """
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def tokens_hash(tokens):
+    """ the key of a track: the hash of its compound tokens (see track_key) """
+    return hashlib.md5(np.asarray(tokens, dtype='<i4').tobytes()).hexdigest()
+
+
+class CompoundShardWriter:
+    """
+    Write the tokens of many tracks to a single shard.
+
+    The encoding names the tokenization stored in the shard ('compound',
+    'events' or 'interarrival'), and the version identifies the settings
+    that produced it. Per-track information (small JSON values, e.g. the
+    filter status of the track) can be added with the tokens.
+
+    The shard is written to a temporary file that replaces the shard on close,
+    so an existing shard can be read while it is rewritten.
+    """
+
+    def __init__(self, filename, encoding='compound', version=None):
+        self.filename = filename
+        self.index = dict(encoding=encoding, version=version, keys=[], offsets=[], lengths=[], paths=[], info=[])
+        self.keys = set()
+        self.offset = 0
+
+        self.file = open(f'{filename}.tmp', 'wb')
+        self.file.write(COMPOUND_HEADER.pack(COMPOUND_MAGIC, 0, 0, 0))
+
+    def add(self, key, midifile, tokens, **info):
+        if key in self.keys:
+            return # duplicate MIDI file
+
+        tokens = np.asarray(tokens, dtype='<i4')
+        self.file.write(tokens.tobytes())
+
+        self.keys.add(key)
+        self.index['keys'].append(key)
+        self.index['offsets'].append(self.offset)
+        self.index['lengths'].append(len(tokens))
+        self.index['paths'].append(os.path.relpath(midifile, os.path.dirname(self.filename)))
+        self.index['info'].append(info)
+        self.offset += len(tokens)
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        # append the index and record its location in the header
+        index = json.dumps(self.index).encode()
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.seek(0)
+        self.file.write(COMPOUND_HEADER.pack(COMPOUND_MAGIC, len(self.keys), index_offset, len(index)))
+        self.file.close()
+        os.replace(self.file.name, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CompoundShard:
+    """
+    Memory-mapped shard with random access by track.
+
+    Indexing by key (the hash of a MIDI file) returns the tokens of the track
+    as an int32 view into the mapped file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            magic, count, index_offset, index_size = COMPOUND_HEADER.unpack(f.read(COMPOUND_HEADER.size))
+            assert magic == COMPOUND_MAGIC, f'{filename} is not a compound shard'
+
+            f.seek(index_offset)
+            index = json.loads(f.read(index_size))
+
+        size = (index_offset - COMPOUND_HEADER.size) // 4
+        self.tokens = np.memmap(filename, dtype='<i4', mode='r', offset=COMPOUND_HEADER.size,
+                                shape=(size,)) if size > 0 else np.zeros(0, dtype='<i4')
+
+        self.encoding = index.get('encoding', 'compound')
+        self.version = index.get('version')
+        directory = os.path.dirname(filename)
+        info = index.get('info', [{}]*len(index['keys']))
+        self.index = {key: (offset, length, os.path.join(directory, path), track_info)
+                      for key, offset, length, path, track_info
+                      in zip(index['keys'], index['offsets'], index['lengths'], index['paths'], info)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        offset, length, _, _ = self.index[key]
+        return self.tokens[offset:offset+length]
+
+    def path(self, key):
+        """ the MIDI file of a track """
+        return self.index[key][2]
+
+    def info(self, key):
+        """ the information recorded with a track """
+        return self.index[key][3]
+
+
+def is_compound_shard(filename):
+    """ shards are named *.bin (see COMPOUND_SHARD); compound text files are named *.compound.txt """
+    return filename.endswith('.bin')
+
+
+@lru_cache(maxsize=16)
+def open_shard(filename):
+    return CompoundShard(filename)
+
+
+def compound_sources(datafiles):
+    """
+    Expand data files (compound text files or shards) into a list of tracks.
+
+    Each track is identified by a source: the name of a .compound.txt file, or
+    a (shard, key) pair. Read the track with read_compound (or read_track).
+    """
+
+    sources = []
+    for filename in datafiles:
+        if isinstance(filename, tuple):
+            sources.append(filename) # already a source
+        elif is_compound_shard(filename):
+            sources.extend((filename, key) for key in open_shard(filename).keys())
+        else:
+            sources.append(filename)
+
+    return sources
+
+
+def track_key(source, tokens=None):
+    """
+    the key of a track from compound_sources: the hash of its compound tokens
+    (see tokens_hash), recorded in the shards at preprocess time. Pass the
+    compound tokens of a text file if they have already been read.
+    """
+    if isinstance(source, tuple):
+        filename, key = source
+        return open_shard(filename).info(key).get('tokens_hash', key) # older shards: the MIDI hash
+
+    if tokens is None:
+        _, tokens, _ = read_track(source)
+
+    return tokens_hash(tokens)
+
+
+def encoding(source):
+    """ the tokenization of a track from compound_sources """
+    return open_shard(source[0]).encoding if isinstance(source, tuple) else 'compound'
+
+
+def read_track(source):
+    """
+    read a track from compound_sources: returns the MIDI filename, the tokens,
+    and the information recorded with the track (empty for text files)
+    """
+    if isinstance(source, tuple):
+        filename, key = source
+        shard = open_shard(filename)
+        return shard.path(key), shard[key].tolist(), shard.info(key)
+
+    with open(source, 'r') as f:
+        return source[:-len('.compound.txt')], [int(token) for token in f.read().split()], {}
+
+
+def read_compound(source):
+    """ read a track from compound_sources: returns the MIDI filename and the compound tokens """
+    assert encoding(source) == 'compound'
+    filename, tokens, _ = read_track(source)
+    return filename, tokens
+
+
+class TrackCache:
+    """
+    Content-addressed cache of tokenized tracks.
+
+    Entries are keyed by the hash of a track (see track_key) and stored
+    under a version that identifies the settings of the tokenization, so
+    changing the settings never reads stale entries. An entry is a dict of
+    arrays (e.g. one token stream per augmentation of the track), stored as
+    <directory>/<version>/<key[:2]>/<key>.npz.
+    """
+
+    def __init__(self, directory, version):
+        self.directory = os.path.join(directory, version)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.npz')
+
+    def load(self, key):
+        """ the cached entry for a track (empty if there is none) """
+        try:
+            with np.load(self.path(key)) as entry:
+                return {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return {}
+
+    def store(self, key, entry):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first: readers never see a partial entry
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **entry)
+        os.replace(tmp, path)
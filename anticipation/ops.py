@@ -4,6 +4,8 @@ Utilities for operating on encoded Midi sequences.
 
 from collections import defaultdict
 
+import numpy as np
+
 from anticipation.config import *
 from anticipation.vocab import *
 
@@ -170,18 +172,19 @@ def anticipate(events, controls, delta=DELTA*TIME_RESOLUTION):
 
     tokens = []
     event_time = 0
+    cursor = 0 # controls[cursor:] have not been consumed
     control_time = controls[0] - ATIME_OFFSET
     for time, dur, note in zip(events[0::3],events[1::3],events[2::3]):
         while event_time >= control_time - delta:
-            tokens.extend(controls[0:3])
-            controls = controls[3:] # consume this control
-            control_time = controls[0] - ATIME_OFFSET if len(controls) > 0 else float('inf')
+            tokens.extend(controls[cursor:cursor+3])
+            cursor += 3 # consume this control
+            control_time = controls[cursor] - ATIME_OFFSET if cursor < len(controls) else float('inf')
 
         assert note < CONTROL_OFFSET
         event_time = time - TIME_OFFSET
         tokens.extend([time, dur, note])
 
-    return tokens, controls
+    return tokens, controls[cursor:]
 
 
 def sparsity(tokens):
@@ -283,3 +286,172 @@ def translate(tokens, dt, seconds=False):
 
 def combine(events, controls):
     return sort(events + [token - CONTROL_OFFSET for token in controls])
+
+
+class EventArray:
+    """
+    A sequence of events and controls backed by an (N,3) int32 array.
+
+    Each row is a (time, dur, note) triple. The methods are vectorized versions
+    of the functions in this module that operate on flat token lists, with
+    identical results; use tolist to convert back to the flat-list format.
+    """
+
+    def __init__(self, tokens=None):
+        if tokens is None:
+            tokens = []
+
+        if isinstance(tokens, EventArray):
+            tokens = tokens.tokens
+
+        self.tokens = np.asarray(tokens, dtype=np.int32).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __eq__(self, other):
+        return isinstance(other, EventArray) and np.array_equal(self.tokens, other.tokens)
+
+    def __repr__(self):
+        return f'EventArray({self.tolist()})'
+
+    def tolist(self):
+        """ the flat token list [time, dur, note, time, dur, note, ...] """
+        return self.tokens.reshape(-1).tolist()
+
+    @property
+    def time(self):
+        return self.tokens[:,0]
+
+    @property
+    def dur(self):
+        return self.tokens[:,1]
+
+    @property
+    def note(self):
+        return self.tokens[:,2]
+
+    def controls(self):
+        """ boolean mask of the rows that are controls (or separators) """
+        return self.note >= CONTROL_OFFSET
+
+    def relative(self):
+        """ (time, dur, note) with the event/control offsets removed """
+        controls = self.controls()
+        time = self.time - np.where(controls, ATIME_OFFSET, TIME_OFFSET)
+        dur = self.dur - np.where(controls, ADUR_OFFSET, DUR_OFFSET)
+        note = self.note - np.where(controls, ANOTE_OFFSET, NOTE_OFFSET)
+        return time, dur, note
+
+    def clip(self, start, end, clip_duration=True, seconds=True):
+        if seconds:
+            start = int(TIME_RESOLUTION*start)
+            end = int(TIME_RESOLUTION*end)
+
+        time, dur, _ = self.relative()
+        keep = (start <= time) & (time <= end)
+        tokens = self.tokens[keep]
+
+        # truncate extended notes
+        if clip_duration:
+            overflow = time[keep] + dur[keep] - end
+            tokens[:,1] -= np.maximum(overflow, 0).astype(np.int32)
+
+        return EventArray(tokens)
+
+    def mask(self, start, end):
+        time, _, _ = self.relative()
+        time = time/float(TIME_RESOLUTION)
+        return EventArray(self.tokens[~((start < time) & (time < end))])
+
+    def sort(self):
+        """ sort sequence of events or controls (but not both) """
+        return EventArray(self.tokens[np.argsort(self.time, kind='stable')])
+
+    def split(self):
+        """ split a sequence into events and controls """
+        controls = self.controls()
+        return EventArray(self.tokens[~controls]), EventArray(self.tokens[controls])
+
+    def pad(self, end_time=None, density=TIME_RESOLUTION):
+        # must pad before separation, anticipation
+        assert not self.controls().any()
+
+        end_time = TIME_OFFSET+(end_time if end_time else self.max_time(seconds=False))
+
+        # rests are inserted after each previous time, at intervals of density
+        previous = np.concatenate([[TIME_OFFSET+0], self.time]).astype(np.int64)
+        gaps = np.append(self.time, end_time) - previous
+        counts = np.where(gaps > density, (gaps-1)//density, 0)
+
+        n = len(self)
+        slots = np.arange(n) + np.cumsum(counts[:n])
+        groups = np.repeat(np.arange(n+1), counts)
+        steps = np.arange(len(groups)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+
+        tokens = np.empty((n + counts.sum(), 3), dtype=np.int32)
+        rests = np.ones(len(tokens), dtype=bool)
+        rests[slots] = False
+        tokens[slots] = self.tokens
+        tokens[rests] = np.stack([previous[groups] + density*steps,
+                                  np.full(len(groups), DUR_OFFSET+0),
+                                  np.full(len(groups), REST)], axis=1)
+
+        return EventArray(tokens)
+
+    def unpad(self):
+        return EventArray(self.tokens[self.note != REST])
+
+    def separated(self):
+        """ boolean mask of the rows at or after the first sequence separator """
+        return np.cumsum(self.note == SEPARATOR) > 0
+
+    def min_time(self, seconds=True, instr=None):
+        # stop calculating at sequence separator
+        time, _, note = self.relative()
+        keep = ~self.separated()
+
+        # min time of a particular instrument
+        if instr is not None:
+            keep &= note//2**7 == instr
+
+        mt = int(time[keep].min()) if keep.any() else 0
+        return mt/float(TIME_RESOLUTION) if seconds else mt
+
+    def max_time(self, seconds=True, instr=None):
+        # keep checking for max_time, even if it appears after a separator
+        # (this is important because we use this check for vocab overflow in tokenization)
+        time, _, note = self.relative()
+        keep = self.note != SEPARATOR
+
+        # max time of a particular instrument
+        if instr is not None:
+            keep &= note//2**7 == instr
+
+        mt = max(0, int(time[keep].max())) if keep.any() else 0
+        return mt/float(TIME_RESOLUTION) if seconds else mt
+
+    def get_instruments(self):
+        _, _, note = self.relative()
+        instrs, first, counts = np.unique(note[self.note < SPECIAL_OFFSET]//2**7,
+                                          return_index=True, return_counts=True)
+
+        # same insertion order as get_instruments
+        instruments = defaultdict(int)
+        for k in np.argsort(first):
+            instruments[int(instrs[k])] = int(counts[k])
+
+        return instruments
+
+    def translate(self, dt, seconds=False):
+        if seconds:
+            dt = int(TIME_RESOLUTION*dt)
+
+        # stop translating after EOT
+        shift = np.where(self.separated(), 0, dt)
+        time, _, _ = self.relative()
+        assert (0 <= (time + shift)[self.note != SEPARATOR]).all()
+
+        tokens = self.tokens.copy()
+        tokens[:,0] += shift.astype(np.int32)
+        return EventArray(tokens)
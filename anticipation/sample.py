@@ -3,7 +3,11 @@ API functions for sampling from anticipatory infilling models.
 """
 
 import math
+import weakref
 
+from collections import defaultdict, deque
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 
@@ -52,6 +56,26 @@ def nucleus(logits, top_p):
     return logits
 
 
+def nucleus_batch(logits, top_p):
+    """ nucleus for a batch of logits (rows x vocab) """
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+
+        # Remove tokens with cumulative probability above the threshold (token with 0 are kept)
+        sorted_indices_to_remove = cumulative_probs > top_p
+
+        # Shift the indices to the right to keep also the first token above the threshold
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+
+        # scatter sorted tensors to original indexing
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
+        logits[indices_to_remove] = -float("inf")
+
+    return logits
+
+
 def future_logits(logits, curtime):
     """ don't sample events in the past """
     if curtime > 0:
@@ -73,31 +97,474 @@ def instr_logits(logits, full_history):
     return logits
 
 
-def add_token(model, z, tokens, top_p, current_time, temperature=1.0, debug=False):
+class InstrumentTracker:
+    """
+    Incrementally track the instruments of a growing token sequence.
+
+    Equivalent to ops.get_instruments over the full sequence, but each update
+    only visits the tokens appended since the previous update.
+    """
+
+    def __init__(self, tokens=None):
+        self.reset()
+        if tokens is not None:
+            self.update(tokens)
+
+    def reset(self):
+        self.instruments = defaultdict(int)
+        self.length = 0
+        self.mask = None
+
+    def update(self, tokens):
+        if len(tokens) < self.length:
+            self.reset() # the sequence was replaced: start over
+
+        for instr, count in ops.get_instruments(tokens[self.length:]).items():
+            if instr not in self.instruments:
+                self.mask = None
+
+            self.instruments[instr] += count
+
+        self.length = len(tokens)
+        return self
+
+    def allowed(self):
+        """ instruments that may be sampled (None if there is no constraint) """
+        if len(self.instruments) < 15: # 16 - 1 to account for the reserved drum track
+            return None
+
+        if self.mask is None:
+            self.mask = [instr in self.instruments for instr in range(MAX_INSTR)]
+
+        return self.mask
+
+
+LOGIT_MASKS = {}
+
+def logit_masks(device):
+    """ additive masks for each slot of an event (see safe_logits), cached per device """
+    if device not in LOGIT_MASKS:
+        masks = torch.zeros(3, VOCAB_SIZE)
+        for idx in range(3):
+            masks[idx] = safe_logits(masks[idx], idx)
+
+        LOGIT_MASKS[device] = (masks.to(device), torch.arange(MAX_TIME, device=device))
+
+    return LOGIT_MASKS[device]
+
+
+SLOT_VOCAB = {}
+
+def slot_vocab(device):
+    """ the tokens that safe_logits permits in each slot of an event, cached per device """
+    if device not in SLOT_VOCAB:
+        masks, _ = logit_masks(device)
+        SLOT_VOCAB[device] = [torch.nonzero(mask == 0).squeeze(1) for mask in masks]
+
+    return SLOT_VOCAB[device]
+
+
+def sample_slot(logits, idx, top_p, temperature=1.0):
+    """
+    Sample a batch of tokens for the slot idx % 3 of an event.
+
+    Samples the same distribution as nucleus followed by softmax(logits/temperature)
+    over logits that have been constrained by constrain_logits. But only the
+    (at most MAX_NOTE+1) tokens that are legal in the slot are sorted and
+    normalized, rather than the full vocabulary.
+
+    Inputs:
+      logits      : rows x VOCAB_SIZE constrained logits (or rows x slot vocabulary)
+      idx         : sequence position of the sampled token
+      top_p       : nucleus sampling threshold
+      temperature : sampling temperature
+
+    Returns:
+      tokens      : sampled token for each row
+    """
+
+    vocab = slot_vocab(logits.device)[idx % 3]
+    if logits.shape[-1] == VOCAB_SIZE:
+        logits = logits.index_select(-1, vocab)
+
+    logits = nucleus_batch(logits, top_p)
+    probs = F.softmax(logits / temperature, dim=-1)
+
+    return vocab[torch.multinomial(probs, 1).squeeze(1)]
+
+
+def constrain_logits(logits, idx, curtime, instruments):
+    """
+    Apply all the sampling constraints to a batch of logits (in place).
+
+    Equivalent to safe_logits, future_logits (for the time slot) and instr_logits
+    (for the note slot) applied to every row, using precomputed masks.
+
+    Inputs:
+      logits      : rows x VOCAB_SIZE next-token logits (or rows x slot vocabulary)
+      idx         : sequence position of the next token (shared slot idx % 3)
+      curtime     : per-row (relative) times before which events may not be sampled
+      instruments : per-row InstrumentTracker
+    """
+
+    masks, times = logit_masks(logits.device)
+    if logits.shape[-1] == VOCAB_SIZE:
+        logits += masks[idx % 3]
+        time_offset, note_offset = TIME_OFFSET, NOTE_OFFSET
+    else:
+        # already restricted to slot_vocab: the time/note block comes first
+        time_offset = note_offset = 0
+
+    if idx % 3 == 0:
+        curtime = torch.tensor(curtime, device=logits.device).unsqueeze(1)
+        logits[:,time_offset:time_offset+MAX_TIME].masked_fill_(times < curtime, -float('inf'))
+    elif idx % 3 == 2:
+        allowed = [tracker.allowed() for tracker in instruments]
+        if any(mask is not None for mask in allowed):
+            allowed = torch.tensor([MAX_INSTR*[True] if mask is None else mask for mask in allowed],
+                                   device=logits.device)
+            notes = logits[:,note_offset:note_offset+MAX_NOTE].view(-1, MAX_INSTR, MAX_PITCH)
+            notes.masked_fill_(~allowed.unsqueeze(2), -float('inf'))
+
+    return logits
+
+
+SLOT_PROJECTIONS = {}
+
+def slot_projection(model, slot):
+    """ rows of the model's output projection for the slot vocabulary, cached per model """
+    head = model.get_output_embeddings()
+    stamp = (head.weight.data_ptr(), head.weight._version)
+    if id(head) not in SLOT_PROJECTIONS or SLOT_PROJECTIONS[id(head)][0] != stamp:
+        if id(head) not in SLOT_PROJECTIONS:
+            weakref.finalize(head, SLOT_PROJECTIONS.pop, id(head), None)
+
+        projections = []
+        for vocab in slot_vocab(head.weight.device):
+            weight = head.weight.detach().index_select(0, vocab)
+            bias = None if head.bias is None else head.bias.detach().index_select(0, vocab)
+            projections.append((weight, bias))
+
+        SLOT_PROJECTIONS[id(head)] = (stamp, projections)
+
+    return SLOT_PROJECTIONS[id(head)][1][slot]
+
+
+def forward(model, input_tokens, idx, structured=False, **kwargs):
+    """
+    Run the model over a batch of inputs.
+
+    Inputs:
+      input_tokens : rows x length input tokens
+      idx          : sequence position of the next token
+      structured   : only compute logits for the slot vocabulary of idx % 3
+      kwargs       : passed to the model (past_key_values, attention_mask, etc.)
+
+    Returns:
+      logits       : next-token logits (rows x VOCAB_SIZE, or rows x slot vocabulary)
+      past         : the model's past key/values
+    """
+
+    if structured:
+        # skip the full output projection: only project onto the legal tokens
+        output = model.base_model(input_tokens, use_cache=True, **kwargs)
+        weight, bias = slot_projection(model, idx % 3)
+        logits = F.linear(output.last_hidden_state[:,-1], weight, bias)
+    else:
+        output = model(input_tokens, use_cache=True, **kwargs)
+        logits = output.logits[:,-1]
+
+    return logits, output.past_key_values
+
+
+class DecodingCache:
+    """
+    Key/value cache for incremental decoding.
+
+    Holds the model's past_key_values together with the input sequence that
+    produced them. A query that extends the cached sequence only runs the model
+    over the new suffix. Any other query (the Markov window slid, or the time
+    offset used to relativize the window changed) invalidates the cache and
+    re-prefills it from scratch.
+
+    With structured=True, logits are only computed for the slot vocabulary
+    of the next token (see forward).
+    """
+
+    def __init__(self, structured=False):
+        self.structured = structured
+        self.reset()
+
+    def reset(self):
+        self.inputs = np.zeros(0, dtype=np.int64)
+        self.past = None
+
+    def logits(self, model, inputs):
+        """ next-token logits for the sequence of input tokens (a list or an array) """
+        inputs = np.asarray(inputs, dtype=np.int64)
+        n = len(self.inputs)
+        if self.past is None or n >= len(inputs) or not np.array_equal(inputs[:n], self.inputs):
+            self.reset()
+            n = 0
+
+        input_tokens = torch.from_numpy(inputs[n:]).unsqueeze(0).to(model.device)
+        logits, self.past = forward(model, input_tokens, len(inputs)-1, self.structured,
+                                    past_key_values=self.past)
+        self.inputs = inputs
+
+        return logits[0]
+
+
+def past_tensors(past):
+    """ the (keys, values) of each layer of the model's past key/values (rows x heads x length x dim) """
+    if hasattr(past, 'layers'):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    if hasattr(past, 'key_cache'):
+        return list(zip(past.key_cache, past.value_cache))
+
+    return [tuple(layer[:2]) for layer in past]
+
+
+def make_past(tensors, like):
+    """ past key/values from the (keys, values) of each layer, in the format of like (see past_tensors) """
+    if isinstance(like, tuple):
+        return tuple(tensors)
+    if hasattr(like, 'layers'):
+        return type(like)(tensors)
+
+    return type(like).from_legacy_cache(tuple(tensors))
+
+
+class BatchDecodingCache:
+    """
+    Key/value cache for incremental decoding of a batch of sequences.
+
+    The batched counterpart of DecodingCache: each row holds the input sequence
+    that produced its past key/values, and the rows share one batched past,
+    left-padded with masked positions to a common length. A query runs the model
+    over the new suffix of the rows that extend their cached sequence, and
+    re-prefills only the rows whose cache was invalidated (their Markov window
+    slid, or its time offset changed). Re-prefilled rows are merged back into
+    the batch, dropping the padding that has accumulated in the cache.
+    """
+
+    def __init__(self, structured=False):
+        self.structured = structured
+        self.reset()
+
+    def reset(self):
+        self.inputs = []
+        self.past = None
+        self.mask = None # rows x length: 1 for the cached tokens of each row, 0 for padding
+
+    def select(self, rows):
+        """ keep only the given rows of the batch (e.g., drop the rows that finished) """
+        self.inputs = [self.inputs[b] for b in rows]
+        if len(rows) == 0:
+            self.reset()
+        elif self.past is not None:
+            self.past, self.mask = self.rows(rows)
+
+    def rows(self, rows):
+        """ the past key/values and mask of a subset of the rows """
+        if list(rows) == list(range(len(self.mask))):
+            return self.past, self.mask
+
+        index = torch.tensor(rows, dtype=torch.long, device=self.mask.device)
+        tensors = [(keys[index], values[index]) for keys, values in past_tensors(self.past)]
+        return make_past(tensors, self.past), self.mask[index]
+
+    def forward(self, model, suffixes, idx, past=None, mask=None):
+        """ run the model over a suffix of each row, left-padded to a common length """
+        length = max(len(suffix) for suffix in suffixes)
+        input_tokens = np.zeros((len(suffixes), length), dtype=np.int64)
+        new_mask = np.zeros((len(suffixes), length), dtype=np.int64)
+        for b, suffix in enumerate(suffixes):
+            input_tokens[b,length-len(suffix):] = suffix
+            new_mask[b,length-len(suffix):] = 1
+
+        input_tokens = torch.from_numpy(input_tokens).to(model.device)
+        new_mask = torch.from_numpy(new_mask).to(model.device)
+        mask = new_mask if mask is None else torch.cat([mask, new_mask], dim=1)
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)[:,-length:]
+
+        logits, past = forward(model, input_tokens, idx, self.structured, attention_mask=mask,
+                               position_ids=position_ids, past_key_values=past)
+        return logits, past, mask
+
+    def merge(self, parts):
+        """ combine the (rows, past, mask) of several groups of rows into one batch, without padding """
+        length = max(int(mask.sum(dim=1).max()) for _, _, mask in parts)
+
+        rows, layers, masks = [], None, []
+        for part_rows, past, mask in parts:
+            tensors = past_tensors(past)
+            if mask.shape[1] < length:
+                pad = length - mask.shape[1]
+                mask = F.pad(mask, (pad, 0))
+                tensors = [(F.pad(keys, (0, 0, pad, 0)), F.pad(values, (0, 0, pad, 0))) for keys, values in tensors]
+
+            # move the cached positions of each row to the right, in order
+            index = torch.argsort(mask, dim=1, stable=True)[:,-length:]
+            gather = index[:,None,:,None].expand(-1, tensors[0][0].shape[1], -1, tensors[0][0].shape[3])
+            tensors = [(keys.gather(2, gather), values.gather(2, gather)) for keys, values in tensors]
+
+            rows.extend(part_rows)
+            masks.append(mask.gather(1, index))
+            layers = tensors if layers is None else [(torch.cat([k, kk]), torch.cat([v, vv]))
+                                                     for (k, v), (kk, vv) in zip(layers, tensors)]
+
+        order = torch.tensor(np.argsort(rows), device=masks[0].device)
+        tensors = [(keys[order], values[order]) for keys, values in layers]
+        return make_past(tensors, parts[0][1]), torch.cat(masks)[order]
+
+    def logits(self, model, inputs):
+        """ next-token logits for each row's sequence of input tokens (rows at the same slot of an event) """
+        inputs = [np.asarray(seq, dtype=np.int64) for seq in inputs]
+        if self.past is None or len(inputs) != len(self.inputs):
+            self.reset()
+
+        extend, refill = [], []
+        for b, seq in enumerate(inputs):
+            n = len(self.inputs[b]) if self.past is not None else 0
+            if n > 0 and n < len(seq) and np.array_equal(seq[:n], self.inputs[b]):
+                extend.append(b)
+            else:
+                refill.append(b)
+
+        idx = len(inputs[0])-1
+        parts, logits = [], []
+        if extend:
+            past, mask = self.rows(extend)
+            part_logits, past, mask = self.forward(model, [inputs[b][len(self.inputs[b]):] for b in extend],
+                                                   idx, past, mask)
+            parts.append((extend, past, mask))
+            logits.append(part_logits)
+        if refill:
+            part_logits, past, mask = self.forward(model, [inputs[b] for b in refill], idx)
+            parts.append((refill, past, mask))
+            logits.append(part_logits)
+
+        if refill and extend:
+            self.past, self.mask = self.merge(parts)
+        else:
+            self.past, self.mask = parts[0][1], parts[0][2]
+        self.inputs = inputs
+
+        order = torch.tensor(np.argsort(extend + refill), device=logits[0].device)
+        return torch.cat(logits)[order]
+
+
+class ContextWindow:
+    """
+    Array-backed Markov window over a growing token sequence.
+
+    The window is the most recent size tokens of the sequence, with time
+    relativized to the window's minimum time. The window lives in a
+    preallocated int32 buffer: appending an event and sliding the window are
+    (amortized) constant time, and the minimum time of the window is maintained
+    with a monotonic queue, so relativizing the window is a single vectorized
+    subtraction. Like InstrumentTracker, each update only visits the tokens
+    appended since the previous update.
+    """
+
+    def __init__(self, tokens=None, size=1017):
+        assert size % 3 == 0
+        self.size = size
+        self.buffer = np.zeros(4*size, dtype=np.int32)
+        self.reset()
+        if tokens is not None:
+            self.update(tokens)
+
+    def reset(self):
+        self.length = 0          # length of the tracked sequence
+        self.start = 0           # window is self.buffer[self.start:self.end]
+        self.end = 0
+        self.minima = deque()    # (position, time) of events, with increasing times
+        self.separators = deque() # positions of sequence separators
+
+    def update(self, tokens):
+        if len(tokens) < self.length:
+            self.reset() # the sequence was replaced: start over
+
+        # only the most recent tokens can be in the window
+        position = max(self.length, len(tokens) - self.size)
+        new = np.asarray(tokens[position:], dtype=np.int32)
+        self.length = len(tokens)
+        if len(new) == 0:
+            return self
+
+        if self.end + len(new) > len(self.buffer):
+            # compact: move what remains of the window to the front of the buffer
+            keep = min(self.end - self.start, self.size - len(new))
+            self.buffer[:keep] = self.buffer[self.end-keep:self.end]
+            self.start, self.end = 0, keep
+
+        self.buffer[self.end:self.end+len(new)] = new
+        self.end += len(new)
+        self.start = max(self.start, self.end - self.size)
+
+        for i in range(0, len(new), 3):
+            time, note = int(new[i]), int(new[i+2])
+            if note == SEPARATOR:
+                self.separators.append(position+i)
+                continue
+
+            time -= TIME_OFFSET if note < CONTROL_OFFSET else ATIME_OFFSET
+            while self.minima and self.minima[-1][1] >= time:
+                self.minima.pop()
+            self.minima.append((position+i, time))
+
+        # slide the window
+        first = self.length - (self.end - self.start)
+        while self.minima and self.minima[0][0] < first:
+            self.minima.popleft()
+        while self.separators and self.separators[0] < first:
+            self.separators.popleft()
+
+        return self
+
+    def min_time(self):
+        """ minimum time of the window (in ticks; see ops.min_time) """
+        if self.separators:
+            # ops.min_time stops at the first separator
+            return ops.min_time(self.buffer[self.start:self.end].tolist(), seconds=False)
+
+        return self.minima[0][1] if self.minima else 0
+
+    def window(self):
+        """ the window (with time relativized) and its time offset """
+        offset = self.min_time()
+        history = self.buffer[self.start:self.end].astype(np.int64)
+        history[0::3] -= offset
+
+        return history, offset
+
+
+def add_token(model, z, tokens, top_p, current_time, temperature=1.0, debug=False, cache=None, instruments=None, structured=False, context=None):
     assert len(tokens) % 3 == 0
 
-    history = tokens.copy()
-    lookback = max(len(tokens) - 1017, 0)
-    history = history[lookback:] # Markov window
-    offset = ops.min_time(history, seconds=False)
-    history[::3] = [tok - offset for tok in history[::3]] # relativize time in the history buffer
+    if cache is None:
+        # reuse past key/values across the sub-tokens of this event
+        cache = DecodingCache(structured)
+
+    if instruments is None:
+        instruments = InstrumentTracker()
+    instruments.update(tokens)
+
+    if context is None:
+        context = ContextWindow()
+    history, offset = context.update(tokens).window()
 
     new_token = []
     with torch.no_grad():
         for i in range(3):
-            input_tokens = torch.tensor(z + history + new_token).unsqueeze(0).to(model.device)
-            logits = model(input_tokens).logits[0,-1]
-
-            idx = input_tokens.shape[1]-1
-            logits = safe_logits(logits, idx)
-            if i == 0:
-                logits = future_logits(logits, current_time - offset)
-            elif i == 2:
-                logits = instr_logits(logits, tokens)
-            logits = nucleus(logits, top_p)
-
-            probs = F.softmax(logits / temperature, dim=-1)
-            token = torch.multinomial(probs, 1)
+            input_tokens = np.concatenate([z, history, new_token]).astype(np.int64)
+            logits = cache.logits(model, input_tokens)
+
+            idx = len(input_tokens)-1
+            logits = constrain_logits(logits.unsqueeze(0), idx, [current_time - offset], [instruments])
+            token = sample_slot(logits, idx, top_p, temperature)
             new_token.append(int(token))
 
     new_token[0] += offset # revert to full sequence timing
@@ -107,16 +574,73 @@ def add_token(model, z, tokens, top_p, current_time, temperature=1.0, debug=Fals
     return new_token
 
 
-def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION):
+def add_tokens(model, z, tokens, top_p, current_time, temperature=1.0, instruments=None, structured=False, contexts=None, cache=None):
+    """
+    Batched version of add_token: sample one new event for each row.
+
+    Inputs:
+      z            : per-row global control codes
+      tokens       : per-row token sequences (of different lengths)
+      current_time : per-row time before which events may not be sampled
+      instruments  : per-row InstrumentTracker (optional)
+      structured   : only compute logits for the legal slot vocabulary
+      contexts     : per-row ContextWindow (optional)
+      cache        : BatchDecodingCache, reused across events (optional)
+
+    Returns:
+      new_tokens   : per-row sampled events
+    """
+
+    if cache is None:
+        cache = BatchDecodingCache(structured)
+
+    if instruments is None:
+        instruments = [InstrumentTracker() for _ in tokens]
+    for tracker, seq in zip(instruments, tokens):
+        tracker.update(seq)
+
+    if contexts is None:
+        contexts = [ContextWindow() for _ in tokens]
+    windows = [context.update(seq).window() for context, seq in zip(contexts, tokens)]
+    relative_time = [time - offset for time, (_, offset) in zip(current_time, windows)]
+
+    new_tokens = [[] for _ in tokens]
+    with torch.no_grad():
+        for i in range(3):
+            inputs = [np.concatenate([zz, history, new_token]).astype(np.int64)
+                      for zz, (history, _), new_token in zip(z, windows, new_tokens)]
+            logits = cache.logits(model, inputs)
+
+            idx = len(inputs[0])-1 # every row is at the same slot of an event
+            logits = constrain_logits(logits, idx, relative_time, instruments)
+            token = sample_slot(logits, idx, top_p, temperature)
+            for new_token, tok in zip(new_tokens, token.tolist()):
+                new_token.append(tok)
+
+    for new_token, (_, offset) in zip(new_tokens, windows):
+        new_token[0] += offset # revert to full sequence timing
+
+    return new_tokens
+
+
+def prepare_prompt(start_time, inputs=None, controls=None, debug=False):
+    """
+    Set up anticipatory generation starting at start_time (in ticks).
+
+    Returns:
+      z            : global control codes
+      tokens       : the prompt, interleaved with anticipated controls
+      controls     : controls that remain to be anticipated
+      future       : events beyond start_time (returned with the generated events)
+      current_time : time of the last event in the prompt
+    """
+
     if inputs is None:
         inputs = []
 
     if controls is None:
         controls = []
 
-    start_time = int(TIME_RESOLUTION*start_time)
-    end_time = int(TIME_RESOLUTION*end_time)
-
     # prompt is events up to start_time
     prompt = ops.pad(ops.clip(inputs, 0, start_time, clip_duration=False, seconds=False), start_time)
 
@@ -148,10 +672,31 @@ def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0,
     if debug:
         print('Current time:', current_time)
 
+    return z, tokens, controls, future, current_time
+
+
+def sample_events(model, z, tokens, controls, current_time, start_time, end_time, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, cache=None, instruments=None, context=None, structured=False):
+    """
+    Sample events until end_time (in ticks), interleaving anticipated controls.
+
+    Extends tokens in place and yields each new event [time, dur, note] as soon
+    as it is sampled. See prepare_prompt for the inputs z, tokens, controls and
+    current_time.
+    """
+
+    if cache is None:
+        cache = DecodingCache(structured)
+
+    if instruments is None:
+        instruments = InstrumentTracker()
+
+    if context is None:
+        context = ContextWindow()
+
     with tqdm(range(end_time-start_time)) as progress:
         if controls:
             atime, adur, anote = controls[0:3]
-            anticipated_tokens = controls[3:]
+            cursor = 3 # controls[cursor:] have not been anticipated
             anticipated_time = atime - ATIME_OFFSET
         else:
             # nothing to anticipate
@@ -165,15 +710,16 @@ def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0,
                     instr = note//2**7
                     print('A', atime - ATIME_OFFSET, adur - ADUR_OFFSET, instr, note - (2**7)*instr)
 
-                if len(anticipated_tokens) > 0:
-                    atime, adur, anote = anticipated_tokens[0:3]
-                    anticipated_tokens = anticipated_tokens[3:]
+                if cursor < len(controls):
+                    atime, adur, anote = controls[cursor:cursor+3]
+                    cursor += 3
                     anticipated_time = atime - ATIME_OFFSET
                 else:
                     # nothing more to anticipate
                     anticipated_time = math.inf
 
-            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time), temperature)
+            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time), temperature,
+                                  cache=cache, instruments=instruments, context=context)
             new_time = new_token[0] - TIME_OFFSET
             if new_time >= end_time:
                 break
@@ -190,11 +736,216 @@ def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0,
             current_time = new_time
             progress.update(dt)
 
+            yield new_token
+
+
+def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, structured=False):
+    start_time = int(TIME_RESOLUTION*start_time)
+    end_time = int(TIME_RESOLUTION*end_time)
+
+    z, tokens, controls, future, current_time = prepare_prompt(start_time, inputs, controls, debug)
+
+    cache = DecodingCache(structured)
+    for _ in sample_events(model, z, tokens, controls, current_time, start_time, end_time,
+                           top_p, temperature, debug, delta, cache=cache):
+        pass
+
     events, _ = ops.split(tokens)
     return ops.sort(ops.unpad(events) + future)
 
 
-def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION):
+def generate_stream(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, structured=False):
+    """
+    Generate like generate, but yield each new event as soon as it is sampled.
+
+    Yields the sampled events [time, dur, note] in the window [start_time, end_time),
+    in time order. The prompt, the controls and any inputs beyond start_time are
+    not yielded: combine them with the stream as needed (see ops.combine).
+    """
+
+    start_time = int(TIME_RESOLUTION*start_time)
+    end_time = int(TIME_RESOLUTION*end_time)
+
+    z, tokens, controls, future, current_time = prepare_prompt(start_time, inputs, controls, debug)
+
+    cache = DecodingCache(structured)
+    yield from sample_events(model, z, tokens, controls, current_time, start_time, end_time,
+                             top_p, temperature, debug, delta, cache=cache)
+
+
+class GenerationSession:
+    """
+    Persistent state for rolling-window generation (e.g., a live jam).
+
+    The session keeps the token history, the decoding cache and the instrument
+    tracker across calls. New (human) events are merged into the history as
+    they arrive, and each call to generate extends the history into the next
+    window, re-using everything the model has already attended to. The history
+    is event-only: the session does not anticipate controls.
+
+    Event times are absolute session times. History that falls more than
+    MAX_TIME before the end of the requested window is dropped, so that
+    relativized times always remain in the vocabulary.
+    """
+
+    def __init__(self, model, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, structured=False):
+        self.model = model
+        self.top_p = top_p
+        self.temperature = temperature
+        self.debug = debug
+        self.delta = delta
+
+        self.z = [AUTOREGRESS]
+        self.tokens = []
+        self.cache = DecodingCache(structured)
+        self.instruments = InstrumentTracker()
+        self.context = ContextWindow()
+
+    def add_events(self, events):
+        """ merge new events into the history """
+        events = ops.sort(events)
+        if len(events) == 0:
+            return
+
+        # history before the new events is unchanged (and stays cached)
+        k = len(self.tokens)
+        while k > 0 and self.tokens[k-3] - TIME_OFFSET > events[0] - TIME_OFFSET:
+            k -= 3
+
+        tail = ops.sort(ops.unpad(self.tokens[k:]) + events)
+        del self.tokens[k:]
+        self.extend(tail)
+        self.instruments.reset()
+        self.context.reset()
+
+    def extend(self, events, end_time=None):
+        """ append events that follow the history (padding with rests up to end_time) """
+        previous_time = self.tokens[-3] - TIME_OFFSET if self.tokens else 0
+        if end_time is not None:
+            end_time -= previous_time
+
+        events = ops.pad(ops.translate(events, -previous_time), end_time)
+        self.tokens.extend(ops.translate(events, previous_time))
+
+    def trim(self, end_time):
+        """ drop history that can't be relativized together with end_time """
+        k = 0
+        while k < len(self.tokens) and self.tokens[k] - TIME_OFFSET <= end_time - MAX_TIME:
+            k += 3
+
+        if k > 0:
+            del self.tokens[:k]
+            self.instruments.reset()
+            self.context.reset()
+
+    def stream(self, start_time, end_time):
+        """ sample events in the window [start_time, end_time), yielding each new event """
+        start_time = int(TIME_RESOLUTION*start_time)
+        end_time = int(TIME_RESOLUTION*end_time)
+
+        self.extend([], start_time)
+        self.trim(end_time)
+
+        current_time = self.tokens[-3] - TIME_OFFSET if self.tokens else 0
+        yield from sample_events(self.model, self.z, self.tokens, [], current_time, start_time, end_time,
+                                 self.top_p, self.temperature, self.debug, self.delta,
+                                 cache=self.cache, instruments=self.instruments, context=self.context)
+
+    def generate(self, start_time, end_time):
+        """ sample events in the window [start_time, end_time) """
+        return [token for event in self.stream(start_time, end_time) for token in event]
+
+
+def batch_rows(sequences, num_samples):
+    """ broadcast a shared token sequence (or None) to one sequence per row """
+    if sequences is not None and len(sequences) > 0 and isinstance(sequences[0], list):
+        assert len(sequences) == num_samples
+        return sequences
+
+    return num_samples*[sequences]
+
+
+def generate_batch(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, temperature=1.0, num_samples=1, debug=False, delta=DELTA*TIME_RESOLUTION, structured=False):
+    """
+    Sample several continuations in parallel, with one batched forward pass per step.
+
+    The inputs and controls are either a single sequence, shared by all num_samples
+    continuations, or a list of num_samples sequences (one prompt per continuation).
+    Each row anticipates its own controls and stops independently at end_time.
+    The rows share a BatchDecodingCache across events, so (like generate) each
+    step only runs the model over the tokens that are new to each row.
+
+    Returns a list of num_samples event sequences (see generate).
+    """
+
+    start_time = int(TIME_RESOLUTION*start_time)
+    end_time = int(TIME_RESOLUTION*end_time)
+
+    inputs = batch_rows(inputs, num_samples)
+    controls = batch_rows(controls, num_samples)
+
+    rows = []
+    for b in range(num_samples):
+        if debug:
+            print(f'Row {b}')
+
+        z, tokens, anticipated, future, current_time = prepare_prompt(start_time, inputs[b], controls[b], debug)
+        rows.append(dict(z=z, tokens=tokens, controls=anticipated, cursor=0, future=future,
+                         current_time=current_time, instruments=InstrumentTracker(),
+                         context=ContextWindow(), done=False))
+
+    cache = BatchDecodingCache(structured)
+    with tqdm(range(num_samples*(end_time-start_time))) as progress:
+        while True:
+            active = [row for row in rows if not row['done']]
+            if len(active) == 0:
+                break
+
+            for row in active:
+                # interleave this row's controls that fall within the anticipation interval
+                anticipated, cursor = row['controls'], row['cursor']
+                while cursor < len(anticipated) and row['current_time'] >= anticipated[cursor] - ATIME_OFFSET - delta:
+                    row['tokens'].extend(anticipated[cursor:cursor+3])
+                    cursor += 3
+                row['cursor'] = cursor
+
+            new_tokens = add_tokens(model,
+                                    [row['z'] for row in active],
+                                    [row['tokens'] for row in active],
+                                    top_p,
+                                    [max(start_time,row['current_time']) for row in active],
+                                    temperature,
+                                    [row['instruments'] for row in active],
+                                    structured,
+                                    [row['context'] for row in active],
+                                    cache)
+
+            for row, new_token in zip(active, new_tokens):
+                new_time = new_token[0] - TIME_OFFSET
+                if new_time >= end_time:
+                    row['done'] = True
+                    progress.update(end_time - max(start_time, row['current_time']))
+                    continue
+
+                row['tokens'].extend(new_token)
+                dt = new_time - row['current_time']
+                assert dt >= 0
+                progress.update(new_time - max(start_time, row['current_time']))
+                row['current_time'] = new_time
+
+            # drop the rows that finished from the cache
+            if any(row['done'] for row in active):
+                cache.select([b for b, row in enumerate(active) if not row['done']])
+
+    outputs = []
+    for row in rows:
+        events, _ = ops.split(row['tokens'])
+        outputs.append(ops.sort(ops.unpad(events) + row['future']))
+
+    return outputs
+
+
+def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1.0, temperature=1.0, debug=False, delta=DELTA*TIME_RESOLUTION, structured=False):
     if inputs is None:
         inputs = []
 
@@ -230,17 +981,21 @@ def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1
         print('Current time:', current_time)
 
     tokens = prompt
+    cache = DecodingCache(structured)
+    instruments = InstrumentTracker()
+    context = ContextWindow()
     with tqdm(range(end_time-start_time)) as progress:
         if controls:
             atime, adur, anote = controls[0:3]
-            anticipated_tokens = controls[3:]
+            cursor = 3 # controls[cursor:] have not been backfilled
             anticipated_time = atime - TIME_OFFSET
         else:
             # nothing to anticipate
             anticipated_time = math.inf
 
         while True:
-            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time), temperature)
+            new_token = add_token(model, z, tokens, top_p, max(start_time,current_time), temperature,
+                                  cache=cache, instruments=instruments, context=context)
             new_time = new_token[0] - TIME_OFFSET
             if new_time >= end_time:
                 break
@@ -257,9 +1012,9 @@ def generate_ar(model, start_time, end_time, inputs=None, controls=None, top_p=1
                     instr = note//2**7
                     print('A', atime - TIME_OFFSET, adur - DUR_OFFSET, instr, note - (2**7)*instr)
 
-                if len(anticipated_tokens) > 0:
-                    atime, adur, anote = anticipated_tokens[0:3]
-                    anticipated_tokens = anticipated_tokens[3:]
+                if cursor < len(controls):
+                    atime, adur, anote = controls[cursor:cursor+3]
+                    cursor += 3
                     anticipated_time = atime - TIME_OFFSET
                 else:
                     # nothing more to anticipate
@@ -0,0 +1,266 @@
+"""
+A fast reader for Standard MIDI Files.
+
+Decodes the chunks of a MIDI file directly from its bytes, keeping only what
+the converters need: note_on, note_off and program_change messages, the tempo
+map, and the times of all other messages (which determine how mido accumulates
+time over the merged tracks). Files are read exactly as mido reads them: if a
+file is malformed or uses anything unusual, the reader raises SMFError and the
+caller should fall back to mido (which then either parses the file or raises
+its own error).
+
+Times are converted from ticks to seconds with a TempoMap, which is built once
+per file and converts the ticks of every event in one vectorized pass.
+"""
+
+import struct
+
+import numpy as np
+
+from mido.messages import SPEC_BY_STATUS
+from mido.midifiles.meta import build_meta_message
+
+from anticipation.config import TIME_RESOLUTION
+
+
+MAX_MESSAGE_LENGTH = 1000000 # mido's limit on the length of a message
+MAX_TICK = 2**53             # absolute ticks must fit in an int64 (and a float64)
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+SET_TEMPO = 0x51
+END_OF_TRACK = 0x2F
+
+
+class SMFError(Exception):
+    """ the file can't be read by the fast reader: fall back to mido """
+
+
+class Track:
+    """
+    The messages of one track (times are absolute, in ticks).
+
+    Attributes:
+      events : (N,4) array of (tick, status, data1, data2) for note_on, note_off and program_change
+      tempos : (K,2) array of (tick, tempo) for set_tempo
+      ticks  : ticks of every message except end_of_track
+    """
+
+    def __init__(self, events, tempos, ticks):
+        self.events = np.array(events, dtype=np.int64).reshape(-1, 4)
+        self.tempos = np.array(tempos, dtype=np.int64).reshape(-1, 2)
+        self.ticks = np.array(ticks, dtype=np.int64)
+
+
+class SMF:
+    """ a parsed Standard MIDI File """
+
+    def __init__(self, format, ticks_per_beat, tracks):
+        self.format = format
+        self.ticks_per_beat = ticks_per_beat
+        self.tracks = tracks
+
+
+def read_varint(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos
+
+
+def read_track(data, pos, end):
+    events = []
+    tempos = []
+    ticks = []
+
+    tick = 0
+    last_status = None
+    while pos < end:
+        delta, pos = read_varint(data, pos)
+        tick += delta
+
+        status = data[pos]
+        pos += 1
+        if status < 0x80: # running status
+            if last_status is None or last_status >= 0xF0:
+                raise SMFError('running status')
+
+            status = last_status
+            pos -= 1
+        elif status != 0xFF:
+            last_status = status
+
+        if status == 0xFF: # meta message
+            meta_type = data[pos]
+            length, pos = read_varint(data, pos+1)
+            if length > MAX_MESSAGE_LENGTH or pos + length > len(data):
+                raise SMFError('meta message length')
+
+            payload = data[pos:pos+length]
+            pos += length
+            if meta_type == END_OF_TRACK:
+                continue
+
+            try:
+                message = build_meta_message(meta_type, list(payload))
+            except Exception:
+                raise SMFError('meta message')
+
+            if message.type == 'unknown_meta':
+                tick -= delta # mido drops the delta time of unknown meta messages
+            elif meta_type == SET_TEMPO:
+                tempos.append((tick, message.tempo))
+        elif status == 0xF0 or status == 0xF7: # sysex
+            length, pos = read_varint(data, pos)
+            if length > MAX_MESSAGE_LENGTH or pos + length > len(data):
+                raise SMFError('sysex length')
+
+            payload = data[pos:pos+length]
+            pos += length
+            if payload[:1] == b'\xf0':
+                payload = payload[1:]
+            if payload[-1:] == b'\xf7':
+                payload = payload[:-1]
+            if any(byte > 127 for byte in payload):
+                raise SMFError('sysex data')
+        else:
+            if status < 0xF0:
+                length = 2 if (status & 0xF0) in (PROGRAM_CHANGE, 0xD0) else 3
+            elif status in SPEC_BY_STATUS:
+                length = SPEC_BY_STATUS[status]['length']
+            else:
+                raise SMFError(f'undefined status byte 0x{status:02x}')
+
+            message = data[pos:pos+length-1]
+            pos += length-1
+            if len(message) < length-1 or any(byte > 127 for byte in message):
+                raise SMFError('channel message data')
+
+            kind = status & 0xF0
+            if kind == NOTE_ON or kind == NOTE_OFF:
+                events.append((tick, status, message[0], message[1]))
+            elif kind == PROGRAM_CHANGE:
+                events.append((tick, status, message[0], 0))
+
+        ticks.append(tick)
+
+    if pos != end or tick > MAX_TICK:
+        raise SMFError('track length')
+
+    return Track(events, tempos, ticks), pos
+
+
+def parse(data):
+    """ parse the bytes of a MIDI file (raises SMFError if it should be parsed by mido) """
+    try:
+        name, size = struct.unpack_from('>4sL', data, 0)
+        if name != b'MThd' or size < 6:
+            raise SMFError('file header')
+
+        format, num_tracks, ticks_per_beat = struct.unpack_from('>hhh', data, 8)
+        if format == 2 or ticks_per_beat <= 0:
+            raise SMFError('format')
+
+        tracks = []
+        pos = 8 + size
+        for _ in range(num_tracks):
+            name, size = struct.unpack_from('>4sL', data, pos)
+            if name != b'MTrk':
+                raise SMFError('track header')
+
+            track, pos = read_track(data, pos+8, pos+8+size)
+            tracks.append(track)
+    except (IndexError, struct.error):
+        raise SMFError('unexpected end of file')
+
+    return SMF(format, ticks_per_beat, tracks)
+
+
+def read(filename):
+    """ parse a MIDI file (raises SMFError if it should be parsed by mido) """
+    with open(filename, 'rb') as f:
+        return parse(f.read())
+
+
+def merged_events(smf):
+    """ the note and program events of all tracks, in mido's merged order """
+    events = np.concatenate([track.events for track in smf.tracks] + [np.zeros((0,4), dtype=np.int64)])
+    return events[np.argsort(events[:,0], kind='stable')]
+
+
+def instruments(events):
+    """
+    The instrument of each merged event: the latest program on its channel
+    (default 0 = piano), or 128 for drums (channel 9).
+    """
+    channels = events[:,1] & 0x0F
+    programs = (events[:,1] & 0xF0) == PROGRAM_CHANGE
+
+    instrs = np.zeros(len(events), dtype=np.int64)
+    for channel in np.unique(channels):
+        idx = np.flatnonzero(channels == channel)
+        latest = np.maximum.accumulate(np.where(programs[idx], np.arange(len(idx)), -1))
+        instrs[idx] = np.where(latest >= 0, events[idx[np.maximum(latest, 0)], 2], 0)
+
+    instrs[channels == 9] = 128 # special case: channel 9 is drums!
+    return instrs
+
+
+class TempoMap:
+    """
+    Piecewise-linear map from ticks to seconds, built once per file.
+
+    Message times only change at the ticks where some message occurs (the
+    breaks); between breaks, time advances at the tempo set by the latest
+    set_tempo message in merged order. Seconds are accumulated break by break,
+    which reproduces the times of iterating over the merged tracks with mido
+    (time += message.time) exactly. Ticks are converted independently of one
+    another, so the tracks don't need to be merged first.
+
+    All methods take the ticks of messages in the file.
+    """
+
+    def __init__(self, smf):
+        self.breaks = np.unique(np.concatenate([[0]] + [track.ticks for track in smf.tracks]))
+
+        # tempo (in merged order) in effect after each break
+        tempos = np.concatenate([track.tempos for track in smf.tracks] + [np.zeros((0,2), dtype=np.int64)])
+        tempos = tempos[np.argsort(tempos[:,0], kind='stable')]
+        idx = np.searchsorted(tempos[:,0], self.breaks[:-1], side='right') - 1
+        tempo = np.where(idx >= 0, tempos[idx,1] if len(tempos) else 0, 500000)
+
+        # seconds between consecutive breaks (mido's message.time) and since the start
+        self.deltas = np.diff(self.breaks) * (tempo * 1e-6 / smf.ticks_per_beat)
+        self.offsets = np.concatenate([[0.], np.cumsum(self.deltas)])
+
+    def seconds(self, ticks):
+        """ time of each tick (in seconds) """
+        return self.offsets[np.searchsorted(self.breaks, ticks)]
+
+    def bins(self, ticks, resolution=TIME_RESOLUTION):
+        """ time of each tick, quantized to the given resolution (bins per second) """
+        return np.rint(resolution*self.seconds(ticks)).astype(np.int64)
+
+    def elapsed(self, ticks):
+        """
+        Seconds elapsed since the previous tick (or the start of the file) for
+        each of a non-decreasing sequence of ticks, summed message by message
+        as mido accumulates them (dt += message.time).
+        """
+        stops = np.searchsorted(self.breaks, ticks).tolist()
+        deltas = self.deltas.tolist()
+
+        elapsed = []
+        start = 0
+        for stop in stops:
+            dt = 0
+            for delta in deltas[start:stop]:
+                dt += delta
+            elapsed.append(dt)
+            start = stop
+
+        return np.array(elapsed, dtype=np.float64)
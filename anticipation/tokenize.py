@@ -2,76 +2,84 @@
 Top-level functions for preprocessing data to be used for training.
 """
 
+import json
+import hashlib
+
 from tqdm import tqdm
 
 import numpy as np
 
-from anticipation import ops
+from anticipation import ops, dataset
 from anticipation.config import *
 from anticipation.vocab import *
-from anticipation.convert import compound_to_events, midi_to_interarrival
+from anticipation.convert import compound_to_events, midi_to_interarrival, midi_to_encodings
+
+
+def split(all_events, mask):
+    """ split (N,3) events into events and controls: mark the events selected by mask as controls """
+    return all_events[~mask].ravel().tolist(), (CONTROL_OFFSET + all_events[mask]).ravel().tolist()
+
 
+def first(times, start, threshold, ordered=False):
+    """ index of the first time (from start) that is at least threshold; len(times) if there is none """
+    if ordered:
+        return max(start, int(np.searchsorted(times, threshold)))
 
-def extract_spans(all_events, rate):
-    events = []
-    controls = []
-    span = True
-    next_span = end_span = TIME_OFFSET+0
-    for time, dur, note in zip(all_events[0::3],all_events[1::3],all_events[2::3]):
-        assert(note not in [SEPARATOR, REST]) # shouldn't be in the sequence yet
+    hits = times[start:] >= threshold
+    return start + int(hits.argmax()) if hits.any() else len(times)
+
+
+def extract_spans(all_events, rate, rng=np.random):
+    all_events = np.asarray(all_events, dtype=np.int64).reshape(-1, 3)
+    times, notes = all_events[:,0], all_events[:,2]
+    assert ((notes != SEPARATOR) & (notes != REST)).all() # shouldn't be in the sequence yet
+
+    # walk over the spans rather than the events
+    ordered = bool((times[1:] >= times[:-1]).all())
+    mask = np.zeros(len(times), dtype=bool)
+    idx, end_span = 0, TIME_OFFSET+0
+    while idx < len(times):
+        # anticipated span: mark events as controls until the end of the span
+        end = first(times, idx, end_span, ordered)
+        mask[idx:end] = True
+        if end == len(times):
+            break
 
         # end of an anticipated span; decide when to do it again (next_span)
-        if span and time >= end_span:
-            span = False
-            next_span = time+int(TIME_RESOLUTION*np.random.exponential(1./rate))
+        next_span = times[end]+int(TIME_RESOLUTION*rng.exponential(1./rate))
 
         # anticipate a 3-second span
-        if (not span) and time >= next_span:
-            span = True
-            end_span = time + DELTA*TIME_RESOLUTION
+        idx = first(times, end, next_span, ordered)
+        if idx == len(times):
+            break
 
-        if span:
-            # mark this event as a control
-            controls.extend([CONTROL_OFFSET+time, CONTROL_OFFSET+dur, CONTROL_OFFSET+note])
-        else:
-            events.extend([time, dur, note])
+        end_span = times[idx] + DELTA*TIME_RESOLUTION
+        mask[idx] = True
+        idx += 1
 
-    return events, controls
+    return split(all_events, mask)
 
 
 ANTICIPATION_RATES = 10
-def extract_random(all_events, rate):
-    events = []
-    controls = []
-    for time, dur, note in zip(all_events[0::3],all_events[1::3],all_events[2::3]):
-        assert(note not in [SEPARATOR, REST]) # shouldn't be in the sequence yet
-
-        if np.random.random() < rate/float(ANTICIPATION_RATES):
-            # mark this event as a control
-            controls.extend([CONTROL_OFFSET+time, CONTROL_OFFSET+dur, CONTROL_OFFSET+note])
-        else:
-            events.extend([time, dur, note])
+def extract_random(all_events, rate, rng=np.random):
+    all_events = np.asarray(all_events, dtype=np.int64).reshape(-1, 3)
+    notes = all_events[:,2]
+    assert ((notes != SEPARATOR) & (notes != REST)).all() # shouldn't be in the sequence yet
 
-    return events, controls
+    # mark events as controls with probability rate/ANTICIPATION_RATES
+    mask = rng.random(len(notes)) < rate/float(ANTICIPATION_RATES)
+    return split(all_events, mask)
 
 
 def extract_instruments(all_events, instruments):
-    events = []
-    controls = []
-    for time, dur, note in zip(all_events[0::3],all_events[1::3],all_events[2::3]):
-        assert note < CONTROL_OFFSET         # shouldn't be in the sequence yet
-        assert note not in [SEPARATOR, REST] # these shouldn't either
-
-        instr = (note-NOTE_OFFSET)//2**7
-        if instr in instruments:
-            # mark this event as a control
-            controls.extend([CONTROL_OFFSET+time, CONTROL_OFFSET+dur, CONTROL_OFFSET+note])
-            print(f"Instrument {instr} is in the subset; marking note {note} as a control")
-        else:
-            events.extend([time, dur, note])
-            print(f"Instrument {instr} is not in the subset; marking note {note} as an event")
+    all_events = np.asarray(all_events, dtype=np.int64).reshape(-1, 3)
+    notes = all_events[:,2]
+    assert (notes < CONTROL_OFFSET).all()                    # shouldn't be in the sequence yet
+    assert ((notes != SEPARATOR) & (notes != REST)).all()   # these shouldn't either
 
-    return events, controls
+    # mark the notes of the instruments in the subset as controls
+    instrs = (notes-NOTE_OFFSET)//2**7
+    return split(all_events, np.isin(instrs, list(instruments)))
 
 
 def maybe_tokenize(compound_tokens):
@@ -97,125 +105,318 @@ def maybe_tokenize(compound_tokens):
     return events, truncations, 0
 
 
-def tokenize_ia(datafiles, output, augment_factor, idx=0, debug=False):
-    assert augment_factor == 1 # can't augment interarrival-tokenized data
-
-    all_truncations = 0
-    seqcount = rest_count = 0
-    stats = 4*[0] # (short, long, too many instruments, inexpressible)
-    np.random.seed(0)
-
-    with open(output, 'w') as outfile:
-        concatenated_tokens = []
-        for j, filename in tqdm(list(enumerate(datafiles)), desc=f'#{idx}', position=idx+1, leave=True):
-            with open(filename, 'r') as f:
-                _, _, status = maybe_tokenize([int(token) for token in f.read().split()])
-
-            if status > 0:
-                stats[status-1] += 1
-                continue
-
-            filename = filename[:-len('.compound.txt')] # get the original MIDI
-
-            # already parsed; shouldn't raise an exception
-            tokens, truncations = midi_to_interarrival(filename, stats=True)
-            tokens[0:0] = [MIDI_SEPARATOR]
-            concatenated_tokens.extend(tokens)
-            all_truncations += truncations
-
-            # write out full sequences to file
-            while len(concatenated_tokens) >= CONTEXT_SIZE:
-                seq = concatenated_tokens[0:CONTEXT_SIZE]
-                concatenated_tokens = concatenated_tokens[CONTEXT_SIZE:]
-                outfile.write(' '.join([str(tok) for tok in seq]) + '\n')
-                seqcount += 1
-
+def preprocess(filename, fast=True):
+    """
+    Parse a MIDI file once and derive all of its encodings: the compound tokens,
+    the arrival-time events (None if the track is filtered; see maybe_tokenize),
+    and the interarrival tokens, with the filter status of the track and the
+    number of truncated durations and interarrival times.
+    """
+    compound_tokens, (interarrival_tokens, interarrival_truncations) = midi_to_encodings(filename, fast)
+    events, truncations, status = maybe_tokenize(compound_tokens)
+
+    return dict(compound=compound_tokens, events=events, interarrival=interarrival_tokens,
+                status=status, truncations=truncations or 0,
+                interarrival_truncations=interarrival_truncations)
+
+
+def load_events(source, compound_tokens=None):
+    """
+    maybe_tokenize a track from dataset.compound_sources (preprocessed if it is
+    in an events shard), or its compound tokens if they have already been read
+    """
+    if dataset.encoding(source) == 'events':
+        _, events, info = dataset.read_track(source)
+        if info['status'] > 0:
+            return None, None, info['status']
+
+        return events, info['truncations'], 0
+
+    if compound_tokens is None:
+        _, compound_tokens = dataset.read_compound(source)
+
+    return maybe_tokenize(compound_tokens)
+
+
+def load_interarrival(source):
+    """ the interarrival tokens (with truncations) and filter status of a track from dataset.compound_sources """
+    if dataset.encoding(source) == 'interarrival':
+        _, tokens, info = dataset.read_track(source)
+        return tokens, info['truncations'], info['status']
+
+    filename, compound_tokens = dataset.read_compound(source) # filename of the original MIDI
+    _, _, status = maybe_tokenize(compound_tokens)
+    if status > 0:
+        return None, None, status
+
+    # already parsed; shouldn't raise an exception
+    tokens, truncations = midi_to_interarrival(filename, stats=True, fast=True)
+    return tokens, truncations, 0
+
+
+TOKENIZATION_VERSION = 1 # increment when changes to the code change the tokenization of a track
+
+
+def settings_version():
+    """
+    Fingerprint of the code version and settings that determine how tracks are
+    preprocessed and tokenized (e.g., for versioning dataset.TrackCache entries).
+    """
+    settings = dict(version=TOKENIZATION_VERSION, delta=DELTA, time_resolution=TIME_RESOLUTION,
+                    max_duration=MAX_DURATION_IN_SECONDS, max_interarrival=MAX_INTERARRIVAL_IN_SECONDS,
+                    max_track_instr=MAX_TRACK_INSTR, max_track_time=MAX_TRACK_TIME_IN_SECONDS,
+                    min_track_time=MIN_TRACK_TIME_IN_SECONDS, min_track_events=MIN_TRACK_EVENTS,
+                    anticipation_rates=ANTICIPATION_RATES, vocab_size=VOCAB_SIZE)
+    return hashlib.md5(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def augmentation_rng(key, k):
+    """
+    Random generator for the k-th augmentation of a track, seeded by the hash
+    of its compound tokens (see dataset.track_key): the augmentations of a track are
+    reproducible regardless of how (or where) tracks are processed.
+    """
+    return np.random.default_rng([int(key, 16), k])
+
+
+def augment(all_events, instruments, end_time, k, rng):
+    """
+    The k-th augmentation of a track (events as a token list or an (N,3) array):
+    its (padded) event/control stream and the number of inserted rests.
+    """
+    if k % 10 == 0:
+        # no augmentation
+        events = all_events.copy()
+        controls = []
+    elif k % 10 == 1:
+        # span augmentation
+        lmbda = .05
+        events, controls = extract_spans(all_events, lmbda, rng)
+    elif k % 10 < 6:
+        # random augmentation
+        r = rng.integers(1,ANTICIPATION_RATES)
+        events, controls = extract_random(all_events, r, rng)
+    else:
+        if len(instruments) > 1:
+            # instrument augmentation: at least one, but not all instruments
+            u = 1+rng.integers(len(instruments)-1)
+            subset = rng.choice(instruments, u, replace=False)
+            events, controls = extract_instruments(all_events, subset)
+        else:
+            # no augmentation
+            events = all_events.copy()
+            controls = []
+
+    events = ops.EventArray(events).pad(end_time)
+    rest_count = int((events.note == REST).sum())
+    tokens, controls = ops.anticipate(events.tolist(), controls)
+    assert len(controls) == 0 # should have consumed all controls (because of padding)
+    tokens[0:0] = [SEPARATOR, SEPARATOR, SEPARATOR]
+
+    return tokens, rest_count
+
+
+def tokenize_track(source, augment_factor, cache=None):
+    """
+    Tokenize the augmentations of a track from dataset.compound_sources.
+
+    Returns the filter status of the track (see maybe_tokenize), its truncated
+    durations, and the (tokens, rest count) of each augmentation (tokens as an
+    int32 array). With a cache
+    (dataset.TrackCache), only what is missing from the cache is computed.
+    """
+    compound_tokens = None
+    if isinstance(source, str):
+        _, compound_tokens = dataset.read_compound(source) # read a text file once, for the key and the events
+
+    key = dataset.track_key(source, compound_tokens)
+    entry = cache.load(key) if cache is not None else {}
+    cached = 'status' in entry and (entry['status'] > 0 or
+                                    all(f'tokens-{k}' in entry for k in range(augment_factor)))
+
+    if not cached:
+        all_events, truncations, status = load_events(source, compound_tokens)
+        entry.update(status=status, truncations=truncations or 0)
+        if status == 0:
+            track = ops.EventArray(all_events)
+            instruments = list(track.get_instruments().keys())
+            end_time = track.max_time(seconds=False)
+            for k in range(augment_factor):
+                if f'tokens-{k}' in entry:
+                    continue # already cached
+
+                tokens, rest_count = augment(track.tokens, instruments, end_time, k, augmentation_rng(key, k))
+                entry[f'tokens-{k}'] = np.array(tokens, dtype=np.int32)
+                entry[f'rests-{k}'] = rest_count
+
+        if cache is not None:
+            cache.store(key, entry)
+
+    status, truncations = int(entry['status']), int(entry['truncations'])
+    if status > 0:
+        return status, truncations, []
+
+    return status, truncations, [(entry[f'tokens-{k}'], int(entry[f'rests-{k}']))
+                                 for k in range(augment_factor)]
+
+
+def track_streams(sources, augment_factor, stats, interarrival=False, cache=None):
+    """
+    The token streams of tracks (see dataset.compound_sources), in order: the
+    augmentations of each track, or its interarrival tokens. Yields (tokens, z)
+    for each stream, where z is its global control code, and counts the rests,
+    truncations and filtered tracks in stats (see tokenize).
+    """
+    for source in sources:
+        if interarrival:
+            tokens, truncations, status = load_interarrival(source)
+            streams = [(np.concatenate([[MIDI_SEPARATOR], tokens]), None, 0)] if status == 0 else []
+        else:
+            status, truncations, augmentations = tokenize_track(source, augment_factor, cache)
+            streams = [(tokens, ANTICIPATE if k % 10 != 0 else AUTOREGRESS, rests)
+                       for k, (tokens, rests) in enumerate(augmentations)]
+
+        if status > 0:
+            stats[1+status] += 1
+            continue
+
+        for tokens, z, rests in streams:
+            stats[1] += rests
+            stats[6] += truncations
+            yield tokens, z
+
+
+def relativize(sequences):
+    """
+    Relativize time in each row of a batch of arrival-time sequences to the
+    sequence (see ops.translate and ops.min_time, which stop at the first
+    separator). Returns the sequences and their maximum times (see ops.max_time).
+    """
+    events = sequences.reshape(len(sequences), -1, 3)
+    time, note = events[:,:,0], events[:,:,2]
+
+    separators = note == SEPARATOR
+    before = np.cumsum(separators, axis=1) == 0
+    relative = time - np.where(note < CONTROL_OFFSET, TIME_OFFSET, ATIME_OFFSET)
+    offset = np.where(before, relative, np.iinfo(np.int64).max).min(axis=1)
+    offset = np.where(before.any(axis=1), offset, 0) # no events before the first separator
+
+    shift = np.where(before, offset[:,None], 0)
+    time -= shift
+    max_time = np.maximum(np.where(separators, 0, relative - shift).max(axis=1), 0)
+
+    return sequences, max_time
+
+
+class SequencePacker:
+    """
+    Pack token streams into training sequences, written to a dataset writer.
+
+    The streams (e.g., the augmentations of consecutive tracks) are concatenated
+    and cut into sequences, carrying what remains of each stream over to the
+    next one. Arrival-time sequences have EVENT_SIZE*M tokens, with time
+    relativized to the sequence, prefixed with the global control code of the
+    stream that they start in; sequences whose times overflow the vocabulary
+    are discarded. Interarrival sequences have CONTEXT_SIZE tokens.
+    """
+
+    def __init__(self, outfile, interarrival=False):
+        self.outfile = outfile
+        self.interarrival = interarrival
+        self.length = CONTEXT_SIZE if interarrival else EVENT_SIZE*M
+        self.pending = []   # tokens that don't fill a sequence yet
+        self.size = 0
+        self.z = None       # global control code of the pending sequence
+        self.seqcount = 0
+        self.discarded = 0
+
+    def add(self, tokens, z=None):
+        if self.size == 0:
+            self.z = z
+
+        self.pending.append(np.asarray(tokens, dtype=np.int64))
+        self.size += len(tokens)
+        count = self.size // self.length
+        if count == 0:
+            return
+
+        tokens = np.concatenate(self.pending)
+        sequences = tokens[:count*self.length].reshape(count, self.length)
+        self.pending = [tokens[count*self.length:]]
+        self.size = len(self.pending[0])
+
+        if self.interarrival:
+            self.outfile.extend(sequences)
+            self.seqcount += count
+            return
+
+        # relativize time to the context
+        sequences, max_time = relativize(sequences.copy())
+        keep = max_time < MAX_TIME
+        self.discarded += count - int(keep.sum())
+        if not keep.any():
+            return
+
+        # if a sequence contains SEPARATOR, global controls describe the first track;
+        # they are those of the pending stream until a sequence is written
+        written = np.cumsum(keep) > 0
+        codes = np.where(np.concatenate([[False], written[:-1]]), z, self.z)
+        self.outfile.extend(np.concatenate([codes[keep,None], sequences[keep]], axis=1))
+        self.seqcount += int(keep.sum())
+        self.z = z
+
+
+def tokenize_streams(sources, output, augment_factor, interarrival=False, cache=None):
+    """
+    Tokenize tracks without packing them into sequences (e.g., a chunk of the
+    tracks of a dataset, tokenized in parallel with other chunks): write their
+    token streams (int32) consecutively to output.
+
+    Returns the (length, z) of each stream, to be packed in order with a
+    SequencePacker, and the statistics of the tracks (see tokenize).
+    """
+    if cache is not None:
+        cache = dataset.TrackCache(cache, settings_version())
+
+    stats = 7*[0]
+    streams = []
+    with open(output, 'wb') as f:
+        for tokens, z in track_streams(sources, augment_factor, stats, interarrival, cache):
+            np.asarray(tokens, dtype=np.int32).tofile(f)
+            streams.append((len(tokens), z))
+
+    return streams, stats
+
+
+def tokenize(datafiles, output, augment_factor, idx=0, debug=False, binary=False, progress=True, cache=None, interarrival=False):
+    """
+    Tokenize tracks (see dataset.compound_sources) and pack them into training
+    sequences. With a cache directory, tracks are only tokenized if they are not
+    already in the cache (see dataset.TrackCache).
+
+    Returns the number of sequences, rests, short, long and too many instrument
+    tracks, discarded sequences and truncations.
+    """
+    if cache is not None:
+        cache = dataset.TrackCache(cache, settings_version())
+
+    stats = 7*[0]
+    with dataset.writer(output, binary) as outfile:
+        packer = SequencePacker(outfile, interarrival)
+        sources = dataset.compound_sources(datafiles)
+        sources = tqdm(sources, desc=f'#{idx}', position=idx+1, leave=True, disable=not progress)
+        for tokens, z in track_streams(sources, augment_factor, stats, interarrival, cache):
+            packer.add(tokens, z)
+
+    stats[0], stats[5] = packer.seqcount, packer.discarded
     if debug:
         fmt = 'Processed {} sequences (discarded {} tracks, discarded {} seqs, added {} rest tokens)'
-        print(fmt.format(seqcount, stats[0]+stats[1]+stats[2], stats[3], rest_count))
-
-    return (seqcount, rest_count, stats[0], stats[1], stats[2], stats[3], all_truncations)
-
+        print(fmt.format(stats[0], stats[2]+stats[3]+stats[4], stats[5], stats[1]))
 
-def tokenize(datafiles, output, augment_factor, idx=0, debug=False):
-    tokens = []
-    all_truncations = 0
-    seqcount = rest_count = 0
-    stats = 4*[0] # (short, long, too many instruments, inexpressible)
-    np.random.seed(0)
+    return tuple(stats)
 
-    with open(output, 'w') as outfile:
-        concatenated_tokens = []
-        for j, filename in tqdm(list(enumerate(datafiles)), desc=f'#{idx}', position=idx+1, leave=True):
-            with open(filename, 'r') as f:
-                all_events, truncations, status = maybe_tokenize([int(token) for token in f.read().split()])
 
-            if status > 0:
-                stats[status-1] += 1
-                continue
-
-            instruments = list(ops.get_instruments(all_events).keys())
-            end_time = ops.max_time(all_events, seconds=False)
-
-            # different random augmentations
-            for k in range(augment_factor):
-                if k % 10 == 0:
-                    # no augmentation
-                    events = all_events.copy()
-                    controls = []
-                elif k % 10 == 1:
-                    # span augmentation
-                    lmbda = .05
-                    events, controls = extract_spans(all_events, lmbda)
-                elif k % 10 < 6:
-                    # random augmentation
-                    r = np.random.randint(1,ANTICIPATION_RATES)
-                    events, controls = extract_random(all_events, r)
-                else:
-                    if len(instruments) > 1:
-                        # instrument augmentation: at least one, but not all instruments
-                        u = 1+np.random.randint(len(instruments)-1)
-                        subset = np.random.choice(instruments, u, replace=False)
-                        events, controls = extract_instruments(all_events, subset)
-                    else:
-                        # no augmentation
-                        events = all_events.copy()
-                        controls = []
-
-                if len(concatenated_tokens) == 0:
-                    z = ANTICIPATE if k % 10 != 0 else AUTOREGRESS
-
-                all_truncations += truncations
-                events = ops.pad(events, end_time)
-                rest_count += sum(1 if tok == REST else 0 for tok in events[2::3])
-                tokens, controls = ops.anticipate(events, controls)
-                assert len(controls) == 0 # should have consumed all controls (because of padding)
-                tokens[0:0] = [SEPARATOR, SEPARATOR, SEPARATOR]
-                concatenated_tokens.extend(tokens)
-
-                # write out full sequences to file
-                while len(concatenated_tokens) >= EVENT_SIZE*M:
-                    seq = concatenated_tokens[0:EVENT_SIZE*M]
-                    concatenated_tokens = concatenated_tokens[EVENT_SIZE*M:]
-
-                    # relativize time to the context
-                    seq = ops.translate(seq, -ops.min_time(seq, seconds=False), seconds=False)
-                    assert ops.min_time(seq, seconds=False) == 0
-                    if ops.max_time(seq, seconds=False) >= MAX_TIME:
-                        stats[3] += 1
-                        continue
-
-                    # if seq contains SEPARATOR, global controls describe the first sequence
-                    seq.insert(0, z)
-
-                    outfile.write(' '.join([str(tok) for tok in seq]) + '\n')
-                    seqcount += 1
-
-                    # grab the current augmentation controls if we didn't already
-                    z = ANTICIPATE if k % 10 != 0 else AUTOREGRESS
-
-    if debug:
-        fmt = 'Processed {} sequences (discarded {} tracks, discarded {} seqs, added {} rest tokens)'
-        print(fmt.format(seqcount, stats[0]+stats[1]+stats[2], stats[3], rest_count))
+def tokenize_ia(datafiles, output, augment_factor, idx=0, debug=False, binary=False, progress=True):
+    assert augment_factor == 1 # can't augment interarrival-tokenized data
 
-    return (seqcount, rest_count, stats[0], stats[1], stats[2], stats[3], all_truncations)
+    return tokenize(datafiles, output, augment_factor, idx, debug, binary, progress, interarrival=True)
@@ -8,7 +8,7 @@ from transformers import AutoModelForCausalLM
 
 from anticipation import ops
 from anticipation.visuals import visualize
-from anticipation.sample import generate, generate_ar
+from anticipation.sample import generate_batch, generate_ar
 from anticipation.tokenize import extract_instruments
 from anticipation.convert import midi_to_events, events_to_midi
 from anticipation.config import TIME_RESOLUTION
@@ -58,11 +58,18 @@ def main(args):
             events, controls = extract_instruments(events, [melody])
             prompt = ops.clip(events, 0, args.prompt_length, clip_duration=False)
 
+            if args.anticipatory:
+                # sample all anticipatory accompaniments of this clip in one batch
+                t0 = time.time()
+                accompaniments = generate_batch(model, args.prompt_length, args.clip_length, prompt, controls,
+                                                top_p=0.95, num_samples=args.multiplicity)
+                print(f'Sampled {args.multiplicity} anticipatory accompaniment(s). Sampling time: {time.time()-t0} seconds')
+
             for j in range(args.multiplicity):
                 t0 = time.time()
 
                 if args.anticipatory:
-                    generated_tokens = generate(model, args.prompt_length, args.clip_length, prompt, controls, top_p=0.95)
+                    generated_tokens = accompaniments[j]
                     output = ops.clip(ops.combine(generated_tokens, controls), 0, args.clip_length)
                     mid = events_to_midi(output)
                     mid.save(f'{args.dir}/anticipatory/{idx}-clip-v{j}.mid')
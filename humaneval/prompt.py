@@ -8,7 +8,7 @@ from transformers import AutoModelForCausalLM
 
 from anticipation import ops
 from anticipation.visuals import visualize
-from anticipation.sample import generate
+from anticipation.sample import generate_batch
 from anticipation.convert import midi_to_events, events_to_midi
 
 np.random.seed(0)
@@ -40,10 +40,12 @@ def main(args):
 
             prompt = midi_to_events(os.path.join(args.dir, prompt_midi))
             start_time = ops.max_time(prompt)
-            for j in range(args.multiplicity):
-                t0 = time.time()
+            t0 = time.time()
 
-                generated_tokens = generate(model, start_time, args.clip_length, prompt, controls=[], top_p=0.98)
+            # sample all completions of this prompt in one batch
+            completions = generate_batch(model, start_time, args.clip_length, prompt, controls=[],
+                                         top_p=0.98, num_samples=args.multiplicity)
+            for j, generated_tokens in enumerate(completions):
                 output = ops.clip(generated_tokens, 0, args.clip_length)
                 mid = events_to_midi(output)
                 mid.save(f'{args.dir}/{args.output}/{idx}-clip-v{j}.mid')
@@ -51,7 +53,7 @@ def main(args):
                     visualize(output, f'{args.dir}/{args.output}/{idx}-clip-v{j}.png')
 
 
-                print(f'Generated completion of idx {idx}. Sampling time: {time.time()-t0} seconds')
+            print(f'Generated {args.multiplicity} completion(s) of idx {idx}. Sampling time: {time.time()-t0} seconds')
 
 
 if __name__ == '__main__':
@@ -23,6 +23,7 @@ OSC out (client port 9001):
 
 import sys
 import time
+import heapq
 import logging
 import threading
 import argparse
@@ -41,9 +42,9 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from anticipation import ops
 from anticipation.config import TIME_RESOLUTION, MAX_PITCH, MAX_DUR, MAX_TIME
 from anticipation.vocab import TIME_OFFSET, DUR_OFFSET, NOTE_OFFSET
-from anticipation.sample import generate
+from anticipation.sample import generate, generate_stream, GenerationSession
 
-from shimon_filter import filter_notes, octave_fold, expand_tremolo, nudge_runs, stagger_chords
+from shimon_filter import filter_notes, octave_fold, expand_tremolo, nudge_runs, stagger_chords, NoteStream
 
 logging.basicConfig(
     level=logging.INFO,
@@ -52,6 +53,12 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# Shimon pipeline stages (see shimon_filter): the per-note stages apply to each
+# streamed onset, the sequential stages to the notes released so far
+SHIMON_EXPAND  = ("octave_fold", "expand_tremolo")
+SHIMON_ARRANGE = ("stagger_chords", "nudge_runs", "filter_notes")
+SHIMON_STAGES  = SHIMON_EXPAND + SHIMON_ARRANGE
+
 
 # ── Model loader (handles full checkpoints and LoRA adapters) ─────────────────
 
@@ -128,6 +135,47 @@ class NoteBuffer:
         return time.time() - self._t0
 
 
+# ── Playback scheduler ───────────────────────────────────────────────────────
+
+class OscScheduler:
+    """Sends OSC messages at their wall-clock target times.
+
+    Messages can be added while playback is in progress (e.g. as notes are
+    streamed out of the model); late messages are sent immediately.
+    """
+
+    def __init__(self, client: SimpleUDPClient):
+        self.client = client
+        self._cond = threading.Condition()
+        self._queue: list[tuple] = []   # heap of (target_time, seq, address, args)
+        self._seq = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, schedule: list[tuple]):
+        with self._cond:
+            for (target_time, address, args) in schedule:
+                heapq.heappush(self._queue, (target_time, self._seq, address, args))
+                self._seq += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+
+                target_time, _, address, args = self._queue[0]
+                delay = target_time - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)   # wake early if an earlier message arrives
+                    continue
+
+                heapq.heappop(self._queue)
+
+            log.info("  → %s %s", address, args)
+            self.client.send_message(address, args)
+
+
 # ── Token helpers ─────────────────────────────────────────────────────────────
 
 def notes_to_events(notes: list[tuple]) -> list[int]:
@@ -219,6 +267,8 @@ class JamServer:
         run_interval_ms: float = 150.0,
         run_semitones: int = 3,
         shimonize: bool = True,
+        stream: bool = False,
+        persistent: bool = False,
     ):
         log.info("Loading model from %s …", model_path)
         device = torch.device("cuda:1" if torch.cuda.is_available() else "cpu")
@@ -246,7 +296,10 @@ class JamServer:
         self.run_interval_ms       = run_interval_ms
         self.run_semitones         = run_semitones
         self.shimonize             = shimonize
+        self.stream                = stream
+        self.persistent            = persistent
 
+        self.scheduler = OscScheduler(self.client)
         self._running = False
 
     # ── OSC handlers ──────────────────────────────────────────────────────────
@@ -311,6 +364,9 @@ class JamServer:
     def _generation_loop(self):
         window_num = 0
 
+        # the persistent session keeps the history (human and generated) across windows
+        session = GenerationSession(self.model) if self.persistent else None
+
         while self._running:
             # wait for one full window of human input
             time.sleep(self.window_size)
@@ -341,30 +397,61 @@ class JamServer:
                     name = note_names[pitch % 12] + str(pitch // 12 - 1)
                     log.info("  t=%5.2fs  dur=%.2fs  %s (pitch=%d  instr=%d)",
                              t, dur, name, pitch, instr)
+                if self.persistent:
+                    # continue the session timeline: merge the human notes at session time
+                    gen_start = win_end
+                    session.top_p       = self.top_p
+                    session.temperature = self.temperature
+                    session.add_events(ops.translate(prompt, int(TIME_RESOLUTION * win_start)))
+                else:
+                    # generate from scratch: the prompt window is [0, window_size)
+                    gen_start = self.window_size
+                gen_end = gen_start + self.window_size
+
                 log.info("  %d notes → continuation [%.1f, %.1f]s",
-                         len(notes), self.window_size, self.window_size * 2)
+                         len(notes), gen_start, gen_end)
                 log.info("─────────────────────────────────────────────────")
 
+                if self.stream:
+                    if self.persistent:
+                        stream = session.stream(gen_start, gen_end)
+                    else:
+                        stream = generate_stream(
+                            self.model,
+                            start_time  = gen_start,
+                            end_time    = gen_end,
+                            inputs      = prompt,
+                            controls    = [],
+                            top_p       = self.top_p,
+                            temperature = self.temperature,
+                        )
+                    self._stream_window(window_num, stream, gen_start)
+                    window_num += 1
+                    continue
+
                 with torch.no_grad():
-                    events = generate(
-                        self.model,
-                        start_time  = self.window_size,
-                        end_time    = self.window_size * 2,
-                        inputs      = prompt,
-                        controls    = [],
-                        top_p       = self.top_p,
-                        temperature = self.temperature,
-                    )
+                    if self.persistent:
+                        continuation = session.generate(gen_start, gen_end)
+                    else:
+                        events = generate(
+                            self.model,
+                            start_time  = gen_start,
+                            end_time    = gen_end,
+                            inputs      = prompt,
+                            controls    = [],
+                            top_p       = self.top_p,
+                            temperature = self.temperature,
+                        )
+
+                        # clip to just the new continuation window
+                        continuation = ops.clip(events, gen_start, gen_end,
+                                                clip_duration=False, seconds=True)
             except Exception as exc:
                 log.exception("Generation failed: %s", exc)
                 self.client.send_message("/gen/status", [f"error: {exc}"])
                 window_num += 1
                 continue
 
-            # clip to just the new continuation window
-            continuation = ops.clip(events, self.window_size, self.window_size * 2,
-                                    clip_duration=False, seconds=True)
-
             gen_elapsed = time.time() - t_gen_start
             n_events = len(continuation) // 3
             log.info("Window %d: generated %d events in %.2fs", window_num, n_events, gen_elapsed)
@@ -377,27 +464,12 @@ class JamServer:
             t1 = time.time(); log.info("  pipeline  decode_events  : %5.3f ms  (%d notes)", (t1-t0)*1e3, len(decoded))
 
             if self.shimonize:
-                decoded = octave_fold(decoded, self.pitch_lo, self.pitch_hi)
-                t2 = time.time(); log.info("  pipeline  octave_fold    : %5.3f ms", (t2-t1)*1e3)
-
-                decoded = expand_tremolo(decoded, self.max_note_dur_s,
-                                         self.tremolo_rate, self.tremolo_strike_dur_ms)
-                t3 = time.time(); log.info("  pipeline  expand_tremolo : %5.3f ms  (%d notes)", (t3-t2)*1e3, len(decoded))
-
-                decoded = stagger_chords(decoded, self.stagger_ms)
-                t4 = time.time(); log.info("  pipeline  stagger_chords : %5.3f ms", (t4-t3)*1e3)
-
-                decoded = nudge_runs(decoded, self.run_interval_ms, self.run_semitones)
-                t5 = time.time(); log.info("  pipeline  nudge_runs     : %5.3f ms", (t5-t4)*1e3)
-
-                decoded = filter_notes(decoded, self.min_note_dist_ms, self.max_notes_per_onset)
-                t6 = time.time(); log.info("  pipeline  filter_notes   : %5.3f ms  (%d notes)", (t6-t5)*1e3, len(decoded))
-
-                log.info("  pipeline  TOTAL (shim)   : %5.3f ms", (t6-t0)*1e3)
+                decoded = self._shimonize(decoded, timed=True)
+                t2 = time.time(); log.info("  pipeline  TOTAL (shim)   : %5.3f ms", (t2-t0)*1e3)
             else:
                 log.info("  pipeline  shimonize=False – skipping transforms")
 
-            schedule = notes_to_schedule(decoded, play_start, self.window_size)
+            schedule = notes_to_schedule(decoded, play_start, gen_start)
             t7 = time.time(); log.info("  pipeline  notes_to_sched : %5.3f ms", (t7-t1)*1e3)
             threading.Thread(
                 target=self._playback_thread,
@@ -407,6 +479,70 @@ class JamServer:
 
             window_num += 1
 
+    def _stream_window(self, window_num: int, stream, win_start: float):
+        """Schedule each onset of a generated window as soon as it is sampled.
+
+        stream    : iterator over generated events (generate_stream or GenerationSession.stream)
+        win_start : time (seconds) of the start of the generated window
+        """
+        play_start = time.time()
+        t_first    = None
+        n_events   = 0
+        onset      = []     # events sharing the current onset time
+        shimon     = NoteStream(lambda notes: self._shimonize(notes, SHIMON_EXPAND),
+                                lambda notes: self._shimonize(notes, SHIMON_ARRANGE))
+
+        def flush(onset):
+            decoded = decode_events(onset)
+            if self.shimonize:
+                decoded = shimon.add((onset[0] - TIME_OFFSET) / TIME_RESOLUTION, decoded)
+            self.scheduler.add(notes_to_schedule(decoded, play_start, win_start))
+
+        with torch.no_grad():
+            for event in stream:
+                if t_first is None:
+                    t_first = time.time()
+                    log.info("Window %d: first event after %.1f ms", window_num, (t_first - play_start)*1e3)
+
+                # a chord is complete once the model moves on to a later onset
+                if onset and event[0] != onset[0]:
+                    flush(onset)
+                    onset = []
+
+                onset.extend(event)
+                n_events += 1
+
+            if onset:
+                flush(onset)
+            if self.shimonize:
+                self.scheduler.add(notes_to_schedule(shimon.flush(), play_start, win_start))
+
+        log.info("Window %d: streamed %d events in %.2fs", window_num, n_events, time.time() - play_start)
+
+    def _shimonize(self, notes: list[tuple], stages: tuple = SHIMON_STAGES,
+                   timed: bool = False) -> list[tuple]:
+        """Apply the Shimon pipeline (or some of its stages) to a block of decoded notes.
+
+        stages : names of the stages to apply, in pipeline order
+        timed  : log the time taken by each stage
+        """
+        for name in stages:
+            t_stage = time.time()
+            if name == "octave_fold":
+                notes = octave_fold(notes, self.pitch_lo, self.pitch_hi)
+            elif name == "expand_tremolo":
+                notes = expand_tremolo(notes, self.max_note_dur_s,
+                                       self.tremolo_rate, self.tremolo_strike_dur_ms)
+            elif name == "stagger_chords":
+                notes = stagger_chords(notes, self.stagger_ms)
+            elif name == "nudge_runs":
+                notes = nudge_runs(notes, self.run_interval_ms, self.run_semitones)
+            elif name == "filter_notes":
+                notes = filter_notes(notes, self.min_note_dist_ms, self.max_notes_per_onset)
+            if timed:
+                log.info("  pipeline  %-14s : %5.3f ms  (%d notes)", name, (time.time()-t_stage)*1e3, len(notes))
+        return notes
+
     def _playback_thread(self, schedule: list[tuple]):
         log.info("Playback: sending %d OSC messages to %s:%d",
                  len(schedule), self.client._address, self.client._port)
@@ -489,7 +625,9 @@ def main():
         window_size   = 6.0,
         top_p         = 0.95,
         temperature   = 1.0,
-        shimonize= True
+        shimonize= True,
+        stream        = False,
+        persistent    = False,
     )
     server.run()
 
@@ -1,3 +1,4 @@
+import os
 from argparse import ArgumentParser
 from concurrent.futures import ProcessPoolExecutor
 from glob import glob
@@ -9,6 +10,7 @@ import seaborn as sns
 from tqdm import tqdm
 
 from anticipation.config import *
+from anticipation.dataset import COMPOUND_SHARD, compound_sources, read_compound
 from anticipation.convert import compound_to_events
 from anticipation.tokenize import maybe_tokenize
 
@@ -16,9 +18,8 @@ plt.rcParams['font.family'] = 'serif'
 plt.rcParams['font.serif'] = ['Computer Modern']
 plt.rcParams['font.size'] = 16
 
-def dataset_stats(filename):
-    with open(filename, 'r') as f:
-        compound_tokens = [int(token) for token in f.read().split()]
+def dataset_stats(source):
+    _, compound_tokens = read_compound(source)
 
     _, _, status = maybe_tokenize(compound_tokens)
     time_length = 0 if len(compound_tokens) == 0 else compound_tokens[-5] + compound_tokens[-4]
@@ -44,14 +45,19 @@ def loghist(filename, data, title, xlabel):
 
 
 def main(args):
-    filenames = glob(args.dir + '/**/*.compound.txt', recursive=True)
+    # prefer compound shards to text files in the same directory
+    shards = glob(args.dir + f'/**/{COMPOUND_SHARD}', recursive=True)
+    sharded = set(os.path.dirname(shard) for shard in shards)
+    filenames = [filename for filename in glob(args.dir + '/**/*.compound.txt', recursive=True)
+                 if os.path.dirname(filename) not in sharded]
+    sources = compound_sources(shards + filenames)
 
     print(f'Calculating statistics for the dataset rooted at {args.dir}')
     with ProcessPoolExecutor(max_workers=PREPROC_WORKERS) as executor:
         results = list(tqdm(
-            executor.map(dataset_stats, filenames),
+            executor.map(dataset_stats, sources, chunksize=64),
             desc='Computing statistics',
-            total=len(filenames)))
+            total=len(sources)))
 
     print('Sequences over one hour: ', len([r for r in results if
         r[1] > TIME_RESOLUTION*MAX_TRACK_TIME_IN_SECONDS]))
@@ -5,6 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from anticipation import dataset
 from anticipation.vocab import MIDI_TIME_OFFSET, MIDI_START_OFFSET, TIME_RESOLUTION, SEPARATOR
 from anticipation.ops import max_time
 
@@ -42,10 +43,9 @@ if __name__ == '__main__':
     print(f'Calculating statistics for {args.filename}')
     time_lengths  = []
     token_counts = []
-    with open(args.filename, 'r') as f:
-        for i,line in tqdm(list(enumerate(f))):
-            if i % 10 != 0: continue
-            tokens = [int(token) for token in line.split()]
+    with dataset.load(args.filename) as data:
+        for i in tqdm(range(0, len(data), 10)):
+            tokens = data[i].tolist()
 
             if args.interarrival:
                 time_lengths.append(sum(t-MIDI_TIME_OFFSET for t in tokens if t < MIDI_START_OFFSET))
@@ -1,5 +1,6 @@
 import os,csv,time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -8,70 +9,166 @@ import torch.nn.functional as F
 from transformers import AutoModelForCausalLM
 from tqdm import tqdm
 
-from anticipation.config import EVENT_SIZE
+from anticipation import dataset
+from anticipation.config import *
+from anticipation.vocab import *
 
-def log_loss(model, datafile, subsample):
-    with open(datafile, 'r') as data:
-        ce = torch.empty(0)
-        for i,line in tqdm(list(enumerate(data))):
-            if i % subsample != 0:
-                continue
 
-            tokens = [int(token) for token in line.split()]
-            tokens = torch.tensor(tokens).unsqueeze(0).cuda()
-            with torch.no_grad():
-                logits = model(tokens).logits[0]
-                ce = torch.cat([ce, F.cross_entropy(logits[:-1],tokens[0,1:],reduction='none').cpu()])
+TOKEN_CLASSES = ['event', 'control', 'rest', 'separator']
 
-    return ce
+
+class LossBreakdown:
+    """
+    Histograms of the loss of each token of (arrival-time encoded) sequences.
+
+    The losses of the (time, dur, note) tokens of each event are binned by the
+    class of the event (see TOKEN_CLASSES), by its instrument (MAX_INSTR bins,
+    plus a bin for rests and separators), and by its time relative to the
+    start of the context (one bin per second, plus a bin for separators). Each
+    histogram stores the sum of the losses and the number of tokens in each
+    bin, with a column for each of time, duration and note tokens.
+    """
+
+    def __init__(self):
+        self.bins = dict(classes=len(TOKEN_CLASSES), instruments=MAX_INSTR+1, time=MAX_TIME_IN_SECONDS+1)
+        self.sums = {name: np.zeros((bins, EVENT_SIZE)) for name, bins in self.bins.items()}
+        self.counts = {name: np.zeros((bins, EVENT_SIZE), dtype=np.int64) for name, bins in self.bins.items()}
+
+    def add(self, tokens, ce):
+        """ add the losses ce (B, L-1) of predicting the tokens (B, L) of a batch (after the global control) """
+        triples = tokens[:,1:].numpy().astype(np.int64).reshape(-1, EVENT_SIZE)
+        ce = ce.numpy().reshape(-1, EVENT_SIZE)
+        time, note = triples[:,0], triples[:,2]
+
+        separator = note == SEPARATOR
+        rest = note == REST
+        control = (note >= CONTROL_OFFSET) & ~separator
+        classes = np.select([separator, rest, control], [3, 2, 1], 0)
+
+        instruments = np.where(control, note - ANOTE_OFFSET, note - NOTE_OFFSET) // MAX_PITCH
+        instruments[separator | rest] = MAX_INSTR
+
+        seconds = np.where(control, time - ATIME_OFFSET, time - TIME_OFFSET) // TIME_RESOLUTION
+        seconds = np.clip(seconds, 0, MAX_TIME_IN_SECONDS-1)
+        seconds[separator] = MAX_TIME_IN_SECONDS
+
+        for name, bins in [('classes', classes), ('instruments', instruments), ('time', seconds)]:
+            for k in range(EVENT_SIZE):
+                self.sums[name][:,k] += np.bincount(bins, weights=ce[:,k], minlength=self.bins[name])
+                self.counts[name][:,k] += np.bincount(bins, minlength=self.bins[name])
+
+    def save(self, filename):
+        np.savez(filename, classes=np.array(TOKEN_CLASSES),
+                 **{f'{name}_sum': self.sums[name] for name in self.bins},
+                 **{f'{name}_count': self.counts[name] for name in self.bins})
+
+def load_sequences(datafile, subsample):
+    """ read every subsample-th sequence of a dataset into a tensor (shared by all checkpoints) """
+    with dataset.load(datafile) as data:
+        return torch.from_numpy(np.stack([data[i] for i in range(0, len(data), subsample)]).astype(np.int32))
+
+
+def load_model(ckpt, device):
+    t0 = time.time()
+    model = AutoModelForCausalLM.from_pretrained(ckpt).to(device)
+    return model, time.time()-t0
+
+
+def log_loss(model, sequences, batch_size=1, device='cuda', breakdown=None):
+    ce = torch.empty((len(sequences), sequences.shape[1]-1)) # per-position losses of each sequence
+    for start in tqdm(range(0, len(sequences), batch_size)):
+        tokens = sequences[start:start+batch_size].long().to(device)
+        with torch.no_grad():
+            logits = model(tokens).logits[:,:-1]
+            loss = F.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens[:,1:].reshape(-1),
+                                   reduction='none').view(len(tokens), -1)
+
+        ce[start:start+len(tokens)] = loss.cpu()
+        if breakdown is not None:
+            breakdown.add(sequences[start:start+batch_size], ce[start:start+len(tokens)])
+
+    return ce.flatten()
 
 
 def main(args):
     print(f'Sub-sampling results at rate {args.subsample}')
+    print(f'Evaluating on {args.device} in batches of {args.batch_size} sequences')
+    assert not (args.breakdown and args.interarrival), 'loss breakdown requires the arrival-time encoding'
 
     results = os.path.join(args.model, args.output)
     print(f'Storing results at {results}')
 
     checkpoints = [os.path.join(f.path, 'hf') for f in os.scandir(args.model) if
             f.is_dir() and os.path.basename(f).startswith('step-')]
+    checkpoints.sort(key=lambda ckpt: int(ckpt.split(os.sep)[-2][5:]))
 
     if args.all:
         print('Calculating log-loss for checkpoints:')
         for ckpt in checkpoints:
             print('  ', ckpt)
     else:
-        steps = [int(ckpt.split(os.sep)[-2][5:]) for ckpt in checkpoints]
-        checkpoints = [os.path.join(args.model, f'step-{max(steps)}', 'hf')]
+        checkpoints = checkpoints[-1:]
         print('Calculating log-loss for final checkpoint:')
         print('  ', checkpoints[0])
 
+    fields = ['step', 'loss']
+    if args.bpe:
+        fields.append('bpe')
+    if not args.interarrival:
+        fields.extend(['event_ppl', 'onset_ppl', 'dur_ppl', 'note_ppl'])
+
+    # resume an interrupted sweep: skip the checkpoints that already have results
+    done = set()
+    if os.path.exists(results) and not args.overwrite:
+        with open(results, newline='') as f:
+            reader = csv.DictReader(f)
+            assert reader.fieldnames == fields, f'{results} has different fields: use --overwrite'
+            done = {int(row['step']) for row in reader}
+
+        checkpoints = [ckpt for ckpt in checkpoints if int(ckpt.split(os.sep)[-2][5:]) not in done]
+        print(f'Resuming: skipping {len(done)} checkpoints with results')
+
+    if len(checkpoints) == 0:
+        return
+
     print('Calculating log-loss on dataset:')
     print('  ', args.filename)
-    with open(results, 'w', newline='') as f:
-        fields = ['step', 'loss']
-        if args.bpe:
-            fields.append('bpe')
-        if not args.interarrival:
-            fields.extend(['event_ppl', 'onset_ppl', 'dur_ppl', 'note_ppl'])
+    t0 = time.time()
+    sequences = load_sequences(args.filename, args.subsample)
+    print(f'  loaded {len(sequences)} sequences in {time.time()-t0} seconds')
 
+    with open(results, 'a' if done else 'w', newline='') as f, ThreadPoolExecutor(max_workers=1) as loader:
         writer = csv.DictWriter(f, fieldnames=fields)
-        writer.writeheader()
-        for ckpt in checkpoints:
+        if not done:
+            writer.writeheader()
+
+        # load the next checkpoint in the background while evaluating the current one
+        next_model = loader.submit(load_model, checkpoints[0], args.device)
+        for idx, ckpt in enumerate(checkpoints):
             step = int(ckpt.split(os.sep)[-2][5:])
             print(f'Loading checkpoint (step {step}):')
             print('  ', ckpt)
             t0 = time.time()
-            model = AutoModelForCausalLM.from_pretrained(ckpt).cuda()
-            print(f'  loaded in {time.time()-t0} seconds')
+            model, load_time = next_model.result()
+            print(f'  loaded in {load_time} seconds (waited {time.time()-t0} seconds)')
+            if idx+1 < len(checkpoints):
+                next_model = loader.submit(load_model, checkpoints[idx+1], args.device)
+
+            breakdown = LossBreakdown() if args.breakdown else None
+            ce = log_loss(model, sequences, args.batch_size, args.device, breakdown)
+            del model
 
-            ce = log_loss(model, args.filename, args.subsample)
+            if breakdown is not None:
+                histograms = os.path.join(args.model, f'{os.path.splitext(args.output)[0]}-step-{step}.npz')
+                breakdown.save(histograms)
+                print(f'  loss breakdown stored at {histograms}')
 
             res = {}
             res['step'] = step
             res['loss'] = np.round(ce.mean().item(), 3)
             if args.bpe:
                 # hardcoding length of the LakhMidi test set in hours: 560.98
-                assert os.path.basename(args.filename) == 'test.txt'
+                assert os.path.splitext(os.path.basename(args.filename))[0] == 'test'
                 res['bpe'] = args.subsample*ce.mean().item()*np.log2(np.e)*(len(ce) / (560.98*3600))
             if not args.interarrival:
                 res['event_ppl'] = np.round(np.exp(EVENT_SIZE*ce.mean().item()), 3)
@@ -80,11 +177,12 @@ def main(args):
                 res['note_ppl'] = np.round(np.exp(ce[2::3].mean().item()), 3)
 
             writer.writerow(res)
+            f.flush() # keep the results of finished checkpoints if the sweep is interrupted
 
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='evaluate log-loss for a tokenized dataset')
-    parser.add_argument('-f', '--filename', help='file containing a tokenized dataset')
+    parser.add_argument('-f', '--filename', help='file containing a tokenized dataset (text or binary)')
     parser.add_argument('-m', '--model', help='file containing a model to evaluate')
     parser.add_argument('-o', '--output', help='output file')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose console output')
@@ -96,5 +194,13 @@ if __name__ == '__main__':
             help='request interarrival-time enocoding (default to arrival-time encoding)')
     parser.add_argument('-s', '--subsample', type=int, default=10,
             help='dataset subsampling ratio')
+    parser.add_argument('-b', '--batch-size', type=int, default=8,
+            help='number of sequences to evaluate at once')
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+            help='device to evaluate on (default to cuda if available)')
+    parser.add_argument('--overwrite', action='store_true',
+            help='recompute results for all checkpoints (default to resuming from existing results)')
+    parser.add_argument('--breakdown', action='store_true',
+            help='also store histograms of the loss by token class, instrument, and time (arrival-time encoding)')
 
     main(parser.parse_args())
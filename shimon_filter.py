@@ -7,8 +7,13 @@ constraints of the Shimon marimba robot.
 
 Pipeline order (applied in this sequence):
     octave_fold → expand_tremolo → stagger_chords → nudge_runs → filter_notes
+
+NoteStream applies the pipeline to a window as it is generated, one onset
+at a time.
 """
 
+import heapq
+
 
 def filter_notes(notes: list[tuple], min_note_dist_ms: float = 50, max_notes_per_onset: int = 4) -> list[tuple]:
     """Filter generated notes: drop notes too close in time, cap polyphony per onset.
@@ -141,3 +146,51 @@ def stagger_chords(notes: list[tuple], stagger_ms: float = 10.0) -> list[tuple]:
             result.append((t, dur, pitch, instrument))
 
     return result
+
+
+class NoteStream:
+    """Apply the pipeline to a window one onset at a time, as it is generated.
+
+    The output is the same as applying the pipeline to the whole window:
+
+    expand  : the per-note stages (octave_fold → expand_tremolo), applied to each onset
+    arrange : the sequential stages (stagger_chords → nudge_runs → filter_notes)
+
+    Tremolo strikes fall after the onset of their note, so expanded notes are
+    held back until the stream reaches their time (no later onset can come
+    before them). The sequential stages only look back at earlier notes, so
+    they are re-run over the notes released so far, and the notes past the end
+    of the previous output are new.
+    """
+
+    def __init__(self, expand, arrange):
+        self.expand   = expand
+        self.arrange  = arrange
+        self.pending  = []   # heap of (t, order, note): expanded notes not yet released
+        self.released = []   # expanded notes, in time order
+        self.order    = 0    # ties in time keep the order of the whole-window sort
+        self.emitted  = 0    # number of arranged notes already returned
+
+    def add(self, t: float, notes: list[tuple]) -> list[tuple]:
+        """Add the notes of the onset at time t (later than the previous onset).
+
+        Returns the transformed notes that are ready to play.
+        """
+        for note in self.expand(notes):
+            heapq.heappush(self.pending, (note[0], self.order, note))
+            self.order += 1
+
+        return self._release(t)
+
+    def flush(self) -> list[tuple]:
+        """Release the remaining notes at the end of the window."""
+        return self._release(float('inf'))
+
+    def _release(self, t: float) -> list[tuple]:
+        while self.pending and self.pending[0][0] <= t:
+            self.released.append(heapq.heappop(self.pending)[2])
+
+        notes = self.arrange(self.released)
+        new = notes[self.emitted:]
+        self.emitted = len(notes)
+        return new
@@ -0,0 +1,78 @@
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import midi_to_events
+from anticipation.tokenize import extract_random
+
+
+def reference(events, controls, delta=DELTA*TIME_RESOLUTION):
+    """ the original interleaving: re-slices the remaining controls on every consumed control """
+    if len(controls) == 0:
+        return events, controls
+
+    tokens = []
+    event_time = 0
+    control_time = controls[0] - ATIME_OFFSET
+    for time, dur, note in zip(events[0::3],events[1::3],events[2::3]):
+        while event_time >= control_time - delta:
+            tokens.extend(controls[0:3])
+            controls = controls[3:] # consume this control
+            control_time = controls[0] - ATIME_OFFSET if len(controls) > 0 else float('inf')
+
+        assert note < CONTROL_OFFSET
+        event_time = time - TIME_OFFSET
+        tokens.extend([time, dur, note])
+
+    return tokens, controls
+
+
+def timeit(func, events, controls, trials):
+    t0 = time.time()
+    for _ in range(trials):
+        output = func(events, controls)
+
+    return (time.time() - t0) / trials, output
+
+
+def main(args):
+    np.random.seed(args.seed)
+
+    print(f'Anticipation benchmark (rate={args.rate}/10 controls, trials={args.trials})')
+    print('file                            repeat  events  controls  original (ms)  cursor (ms)  speedup')
+    for filename in args.filename:
+        track = midi_to_events(filename)
+        for repeat in args.repeat:
+            # tile the track to simulate long tracks
+            all_events = []
+            for k in range(repeat):
+                all_events.extend(ops.translate(track, int(k*TIME_RESOLUTION*ops.max_time(track))))
+
+            events, controls = extract_random(all_events, args.rate)
+            events = ops.pad(events, ops.max_time(all_events, seconds=False))
+
+            original, expected = timeit(reference, events, controls, args.trials)
+            cursor, output = timeit(ops.anticipate, events, controls, args.trials)
+            assert output == expected
+
+            print(f'{filename[-30:]:30s}  {repeat:6d}  {len(events)//3:6d}  {len(controls)//3:8d}'
+                  f'  {1000*original:13.2f}  {1000*cursor:11.2f}  {original/cursor:6.1f}x')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='compare the original and linear-time ops.anticipate')
+    parser.add_argument('filename', nargs='*', default=['examples/strawberry.mid'],
+            help='MIDI files to benchmark (e.g., long Lakh tracks)')
+    parser.add_argument('-r', '--repeat', type=int, nargs='+', default=[1, 4, 16],
+            help='number of times to tile each track')
+    parser.add_argument('--rate', type=int, default=5,
+            help='anticipation rate (out of 10) for random augmentation')
+    parser.add_argument('-n', '--trials', type=int, default=3,
+            help='number of timed trials')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='rng seed')
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn.functional as F
+
+from anticipation.sample import nucleus, constrain_logits, sample_slot, slot_vocab, nucleus_batch, InstrumentTracker
+from anticipation.vocab import VOCAB_SIZE
+
+
+def full_vocab(logits, idx, top_p, temperature):
+    """ reference: nucleus sampling over the full vocabulary, one row at a time """
+    tokens = []
+    for row in logits:
+        row = nucleus(row, top_p)
+        probs = F.softmax(row / temperature, dim=-1)
+        tokens.append(int(torch.multinomial(probs, 1)))
+
+    return tokens
+
+
+def sub_vocab(logits, idx, top_p, temperature):
+    return sample_slot(logits, idx, top_p, temperature).tolist()
+
+
+def timeit(func, logits, idx, top_p, temperature, trials):
+    func(logits.clone(), idx, top_p, temperature) # warmup
+    if logits.is_cuda:
+        torch.cuda.synchronize()
+
+    t0 = time.time()
+    for _ in range(trials):
+        func(logits.clone(), idx, top_p, temperature)
+    if logits.is_cuda:
+        torch.cuda.synchronize()
+
+    return (time.time() - t0) / trials
+
+
+def max_divergence(logits, idx, top_p, temperature):
+    """ largest difference between the two sampling distributions """
+    reference = torch.stack([F.softmax(nucleus(row, top_p) / temperature, dim=-1) for row in logits.clone()])
+
+    vocab = slot_vocab(logits.device)[idx % 3]
+    sub = nucleus_batch(logits.index_select(-1, vocab), top_p)
+    probs = torch.zeros_like(reference)
+    probs[:,vocab] = F.softmax(sub / temperature, dim=-1)
+
+    return (probs - reference).abs().max().item()
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    print(f'Nucleus sampling benchmark (device={device}, top_p={args.top_p}, trials={args.trials})')
+    print('slot  batch    full (ms)    sliced (ms)  speedup  max |dp|')
+    for batch in args.batch:
+        for idx in range(3):
+            logits = args.scale*torch.randn(batch, VOCAB_SIZE, device=device)
+            trackers = [InstrumentTracker() for _ in range(batch)]
+            logits = constrain_logits(logits, idx, batch*[0], trackers)
+
+            full = timeit(full_vocab, logits, idx, args.top_p, args.temperature, args.trials)
+            sliced = timeit(sub_vocab, logits, idx, args.top_p, args.temperature, args.trials)
+            divergence = max_divergence(logits, idx, args.top_p, args.temperature)
+            print(f'{idx:4d}  {batch:5d}  {1000*full:11.3f}  {1000*sliced:13.3f}  {full/sliced:6.1f}x  {divergence:.2e}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='compare nucleus sampling over the full vocabulary and the legal slot vocabulary')
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+            help='device to benchmark')
+    parser.add_argument('-b', '--batch', type=int, nargs='+', default=[1, 8, 32],
+            help='batch sizes to benchmark')
+    parser.add_argument('-n', '--trials', type=int, default=100,
+            help='number of timed trials')
+    parser.add_argument('-p', '--top_p', type=float, default=0.98,
+            help='nucleus sampling threshold')
+    parser.add_argument('-t', '--temperature', type=float, default=1.0,
+            help='sampling temperature')
+    parser.add_argument('--scale', type=float, default=4.0,
+            help='scale of the random logits (larger values concentrate the distribution)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='rng seed')
+    main(parser.parse_args())
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import tempfile
+from argparse import ArgumentParser
+from statistics import median
+
+import numpy as np
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import compound_to_events, events_to_compound, events_to_midi
+from anticipation.convert import midi_to_compound, midi_to_events
+from anticipation.tokenize import extract_random
+
+
+def tile(track, size):
+    """ the first size events of a track, repeated (later in time) if it is too short """
+    events = []
+    offset = 0
+    while len(events) < 3*size:
+        events.extend(ops.translate(track, offset))
+        offset = ops.max_time(events, seconds=False) + 1
+
+    return events[:3*size]
+
+
+def synthetic(size, rng, rate=20, instruments=(0, 24, 33, 48, 73, 128)):
+    """ size random events: about rate onsets per second, over a few instruments """
+    times = np.sort(rng.integers(0, int(TIME_RESOLUTION*size/rate), size))
+    durs = rng.integers(1, 2*TIME_RESOLUTION, size)
+    notes = MAX_PITCH*rng.choice(instruments, size) + rng.integers(24, 96, size)
+
+    events = np.stack([TIME_OFFSET+times, DUR_OFFSET+durs, NOTE_OFFSET+notes], axis=1)
+    return events.reshape(-1).tolist()
+
+
+class Fixture:
+    """ the inputs of each benchmark, derived from one sequence of events """
+
+    def __init__(self, name, events, rng, directory):
+        self.name = name
+        self.events = events
+        self.size = len(events)//3
+        self.end_time = ops.max_time(events, seconds=False)
+
+        triples = np.array(events).reshape(-1, 3)
+        self.shuffled = triples[rng.permutation(len(triples))].reshape(-1).tolist()
+
+        rest, self.controls = extract_random(events, 5, rng=rng)
+        self.padded = ops.pad(rest, self.end_time)
+
+        self.compound = events_to_compound(events)
+        self.midifile = os.path.join(directory, f'{name}-{self.size}.mid')
+        events_to_midi(events).save(self.midifile)
+
+
+BENCHMARKS = {
+    'ops.clip': lambda f: ops.clip(f.events, f.end_time//4, 3*f.end_time//4, seconds=False),
+    'ops.pad': lambda f: ops.pad(f.events, f.end_time),
+    'ops.anticipate': lambda f: ops.anticipate(f.padded, f.controls),
+    'ops.sort': lambda f: ops.sort(f.shuffled),
+    'ops.translate': lambda f: ops.translate(f.events, TIME_RESOLUTION),
+    'convert.midi_to_compound': lambda f: midi_to_compound(f.midifile),
+    'convert.midi_to_compound (fast)': lambda f: midi_to_compound(f.midifile, fast=True),
+    'convert.compound_to_events': lambda f: compound_to_events(f.compound),
+    'convert.events_to_midi': lambda f: events_to_midi(f.events),
+}
+
+
+def timeit(func, fixture, trials, warmup):
+    for _ in range(warmup):
+        func(fixture)
+
+    times = []
+    for _ in range(trials):
+        t0 = time.perf_counter()
+        func(fixture)
+        times.append(time.perf_counter() - t0)
+
+    return times
+
+
+def exponent(sizes, times):
+    """ least-squares slope of log(time) against log(size): ~1 for linear scaling """
+    if len(sizes) < 2:
+        return float('nan')
+
+    return np.polyfit(np.log(sizes), np.log(times), 1)[0]
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    benchmarks = {name: func for name, func in BENCHMARKS.items()
+                  if not args.bench or any(pattern in name for pattern in args.bench)}
+
+    results = dict(config=vars(args), benchmarks={})
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = {}
+        for kind in args.fixtures:
+            if kind == 'synthetic':
+                fixtures[kind] = [Fixture(kind, synthetic(size, rng), rng, directory) for size in args.sizes]
+            else:
+                track = midi_to_events(kind)
+                name = os.path.splitext(os.path.basename(kind))[0]
+                fixtures[kind] = [Fixture(name, tile(track, size), rng, directory) for size in args.sizes]
+
+        print(f'Micro-benchmarks (median of {args.trials} trials, time per event in microseconds)')
+        print(f'{"benchmark":32s} {"fixture":12s}' + ''.join(f'{size:>10d}' for size in args.sizes) + '  scaling')
+        for name, func in benchmarks.items():
+            for kind, sized in fixtures.items():
+                times = [median(timeit(func, fixture, args.trials, args.warmup)) for fixture in sized]
+                slope = exponent(args.sizes, times)
+                results['benchmarks'].setdefault(name, {})[kind] = dict(
+                        sizes=args.sizes, median=times, scaling=slope)
+
+                print(f'{name:32s} {sized[0].name[:12]:12s}'
+                      + ''.join(f'{1e6*t/size:10.2f}' for t, size in zip(times, args.sizes))
+                      + f'  n^{slope:.2f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print(f'Results stored at {args.output}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='micro-benchmark the token operations and MIDI conversions')
+    parser.add_argument('fixtures', nargs='*', default=['synthetic', 'examples/strawberry.mid'],
+            help='MIDI files to benchmark on (tiled to each size), or synthetic for random events')
+    parser.add_argument('-z', '--sizes', type=int, nargs='+', default=[1000, 4000, 16000],
+            help='fixture sizes (in events)')
+    parser.add_argument('-b', '--bench', nargs='+',
+            help='only run the benchmarks whose names contain one of these strings')
+    parser.add_argument('-n', '--trials', type=int, default=5,
+            help='number of timed trials')
+    parser.add_argument('-w', '--warmup', type=int, default=1,
+            help='number of untimed warmup runs')
+    parser.add_argument('-o', '--output', help='output file for the results (JSON)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='rng seed for the fixtures')
+    main(parser.parse_args())
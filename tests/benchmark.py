@@ -1,117 +1,225 @@
 import os
-import datetime
+import sys
+import json
 import time
-import pickle
+import platform
+import datetime
+import resource
+import subprocess
 
 from argparse import ArgumentParser
-from tqdm import tqdm
+from statistics import mean, median, pstdev
 
+import numpy as np
 import torch
+import transformers
 from transformers import AutoModelForCausalLM
 
-from anticipation.sample import generate
 from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import midi_to_events
+from anticipation.sample import generate, generate_ar, add_token, DecodingCache, InstrumentTracker, ContextWindow
+
+
+def environment(args, model):
+    """ metadata describing the benchmark run """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return dict(
+        timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+        host=platform.node(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpus=os.cpu_count(),
+        python=sys.version.split()[0],
+        torch=torch.__version__,
+        transformers=transformers.__version__,
+        numpy=np.__version__,
+        cuda=torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        commit=commit,
+        model=args.model,
+        parameters=sum(p.numel() for p in model.parameters()),
+    )
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+    """ peak memory in MB: allocated on the GPU, or the resident set of the process (monotone) on the CPU """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def timeit(func, device, trials, warmup):
+    """ wall-clock times (in seconds) of trials calls to func, after warmup calls """
+    for _ in range(warmup):
+        func()
+
+    times = []
+    for _ in range(trials):
+        synchronize(device)
+        t0 = time.perf_counter()
+        func()
+        synchronize(device)
+        times.append(time.perf_counter() - t0)
+
+    return times
+
+
+def summary(times, **extra):
+    return dict(mean=mean(times), median=median(times), std=pstdev(times), min=min(times), times=times, **extra)
+
+
+def history(events, length):
+    """ the first length events of a piece, repeated (later in time) if it is too short """
+    tokens = []
+    offset = 0
+    while len(tokens) < EVENT_SIZE*length:
+        tokens.extend(ops.translate(events, offset, seconds=False))
+        offset = ops.max_time(tokens, seconds=False) + 1
+
+    return tokens[:EVENT_SIZE*length]
+
+
+def bench_step(model, events, device, args):
+    """ latency of sampling one event (add_token) and of its prefill/decode passes, by context fill """
+    results = []
+    for fill in args.fill:
+        tokens = history(events, fill)
+        current_time = ops.max_time(tokens, seconds=False) if tokens else 0
+        z = [AUTOREGRESS]
+
+        # add_token with a cold cache: prefill the context, then decode the rest of the event
+        def step():
+            add_token(model, z, tokens, args.top_p, current_time, cache=DecodingCache(args.structured),
+                      instruments=InstrumentTracker(), context=ContextWindow())
+
+        reset_memory(device)
+        step_times = timeit(step, device, args.trials, args.warmup)
+
+        # the passes of the model: prefill (the whole context) and decode (one token, with a warm cache)
+        inputs = np.concatenate([z, ContextWindow(tokens).window()[0]]).astype(np.int64)
+        def prefill():
+            with torch.no_grad():
+                DecodingCache(args.structured).logits(model, inputs)
+
+        cache = DecodingCache(args.structured)
+        with torch.no_grad():
+            cache.logits(model, inputs)
+        primed = cache.past
+
+        def decode():
+            with torch.no_grad():
+                cache.inputs, cache.past = inputs, primed
+                cache.logits(model, np.append(inputs, TIME_OFFSET))
+            primed.crop(-1) # drop the decoded token from the (in-place) key/value cache
+
+        prefill_times = timeit(prefill, device, args.trials, args.warmup)
+        decode_times = timeit(decode, device, args.trials, args.warmup) if hasattr(primed, 'crop') else None
+
+        results.append(dict(fill=fill, context=len(inputs),
+                            step=summary(step_times),
+                            prefill=summary(prefill_times),
+                            decode=summary(decode_times) if decode_times else None,
+                            peak_memory=peak_memory(device)))
+        print(f'  fill {fill:4d} events: step {1000*median(step_times):8.2f}ms'
+              f'  prefill {1000*median(prefill_times):8.2f}ms'
+              + (f'  decode {1000*median(decode_times):8.2f}ms' if decode_times else ''))
+
+    return results
+
+
+def bench_generate(func, model, events, device, args):
+    """ throughput (events/second) of generating args.length seconds after a prompt """
+    prompt = ops.clip(events, 0, args.prompt, clip_duration=False)
+    start_time = args.prompt
+    end_time = args.prompt + args.length
+
+    counts = []
+    def run():
+        torch.manual_seed(args.seed)
+        output = func(model, start_time, end_time, inputs=prompt, top_p=args.top_p, structured=args.structured)
+        counts.append(len(ops.clip(output, start_time, end_time)) // EVENT_SIZE)
+
+    reset_memory(device)
+    times = timeit(run, device, args.trials, args.warmup)
+    counts = counts[args.warmup:]
+    throughput = [count/t for count, t in zip(counts, times)]
+    print(f'  {func.__name__}: {median(throughput):8.1f} events/s ({mean(counts):.0f} events in {median(times):.2f}s)')
+
+    return dict(summary(times), events=counts, throughput=summary(throughput),
+                peak_memory=peak_memory(device))
+
 
 def main(args):
-    # initialize the model and tokenizer
-    model = AutoModelForCausalLM.from_pretrained(args.model)
-
-    # set the device to use
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model.to(device)
-
-    # set the seed for reproducibility
-    torch.manual_seed(args.seed)
-
-    interval = args.interval
-    numIntervals = args.numIntervals
-    numSequences = args.sequences
-
-    stats = []
-
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    folder_path = os.path.join(args.output, timestamp)
-
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-
-    log_file_path = os.path.join(folder_path, "log.txt")
-
-    with open(log_file_path, 'a') as f:
-        f.write(f'Model: {args.model}\n')
-        f.write(f'Timestamp: {timestamp}\n')
-        f.write(f'Number of sequences to generate: {numSequences}\n')
-        f.write(f'Generation interval length: {interval} sec.\n')
-        f.write(f'Number of intervals to generate per sequence: {numIntervals}\n')
-        f.write('\n')
-
-    # generate sequences
-    for s in range(numSequences):
-        times = {}
-        tokens = []
-        start_time = 0
-        end_time = interval
-        for i in range(numIntervals):
-            start_clock = time.time()
-            tokens = generate(model, inputs=tokens, start_time=start_time, end_time=end_time, top_p=.98)
-            end_clock = time.time()
-
-            # compute number of instruments
-            num_instr = len(list(ops.get_instruments(tokens).keys()))
-            
-            # track stats
-            if (num_instr, interval) in times:
-                times[(num_instr, interval)].append(end_clock - start_clock)
-            else:
-                times[(num_instr, interval)] = [end_clock - start_clock]
-
-            start_time += interval
-            end_time += interval
-        
-        stats.append(times)
-        
-        with open(log_file_path, 'a') as f:
-            f.write(f'Sample {s+1} of {numSequences}. Generation interval length: {interval} sec.\n')
-
-            f.write('\n')
-            f.write(f'In this sample, intervals were generated with the following number of instruments: {len(times)}\n')
-            f.write('\n')
-
-            f.write('Summary by number of instruments generated:\n')
-            for key, value in times.items():
-                avg_time = sum(value) / len(value)
-                num_instr, interval = key
-                f.write(f"{len(value)} generation interval(s) contained {num_instr} instruments. Average Time: {avg_time}, Average Time/Interval: {avg_time/interval}\n")
-            
-            f.write('\n')
-
-            overall_avg_time = sum([sum(value) / len(value) for value in times.values()]) / len(times)
-            f.write(f"Average generation time for {interval} sec intervals across entire sequence: {overall_avg_time}\n")
-
-            f.write('\n')
-            f.write('Tokens:\n')
-            f.write('\n')
-
-            f.write(' '.join([str(tok) for tok in tokens]) + '\n')
-            f.write('\n')
-    
-    stats_dump_path = os.path.join(folder_path, "stats.pickle")
-    with open(stats_dump_path, 'wb') as f:
-        pickle.dump(stats, f)
+    events = midi_to_events(args.prompt_file)
+    results = dict(config=vars(args), devices={})
+
+    model = None
+    for name in args.device:
+        device = torch.device(name)
+        torch.manual_seed(args.seed)
+        model = AutoModelForCausalLM.from_pretrained(args.model).to(device)
+        model.eval()
+
+        print(f'Benchmarking on {device}')
+        print(' add_token step latency (prefill vs decode) by context fill:')
+        step = bench_step(model, events, device, args)
+        print(' generation throughput:')
+        results['devices'][name] = dict(
+            step=step,
+            generate=bench_generate(generate, model, events, device, args),
+            generate_ar=bench_generate(generate_ar, model, events, device, args))
+
+    results['environment'] = environment(args, model)
+
+    output = args.output
+    if output is None:
+        output = f'benchmark-{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f'Results stored at {output}')
+
 
 if __name__ == '__main__':
-    parser = ArgumentParser(description='benchmark a tripletmidi anticipatory music transformer')
+    parser = ArgumentParser(description='benchmark generation with an anticipatory music transformer')
     parser.add_argument('-m', '--model', help='checkpoint for the model to evaluate')
-    parser.add_argument('-o', '--output', help='output file for samples and logs')
-    parser.add_argument('-N', '--sequences', type=int, default=100,
-        help='number of sequences to generate')
+    parser.add_argument('-o', '--output', help='output file for the results (JSON)')
+    parser.add_argument('-d', '--device', nargs='+', default=['cuda' if torch.cuda.is_available() else 'cpu'],
+        help='devices to benchmark (e.g. cpu cuda)')
+    parser.add_argument('-f', '--prompt-file', default='examples/strawberry.mid',
+        help='MIDI file providing the prompts and contexts')
+    parser.add_argument('--fill', type=int, nargs='+', default=[0, 64, 128, 256, 339],
+        help='context fill levels (in events) for the step latency benchmark')
+    parser.add_argument('-p', '--prompt', type=float, default=5,
+        help='length of the generation prompt in seconds')
+    parser.add_argument('-l', '--length', type=float, default=10,
+        help='length of generated music in seconds')
+    parser.add_argument('-n', '--trials', type=int, default=10,
+        help='number of timed trials of each benchmark')
+    parser.add_argument('-w', '--warmup', type=int, default=2,
+        help='number of untimed warmup runs of each benchmark')
+    parser.add_argument('--top_p', type=float, default=.98,
+        help='nucleus sampling threshold')
+    parser.add_argument('--structured', action='store_true',
+        help='only compute logits over the slot vocabulary')
     parser.add_argument('-s', '--seed', type=int, default=42,
         help='rng seed for sampling')
-    parser.add_argument('-I', '--interval', type=int, default=1,
-        help='generation interval in seconds')
-    parser.add_argument('-n', '--numIntervals', type=int, default=25,
-        help='number of intervals to generate per sequence')
-    parser.add_argument('--debug', action='store_true', help='verbose debugging outputs')
-    args = parser.parse_args()
-
-    main(args)
+
+    main(parser.parse_args())
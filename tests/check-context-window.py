@@ -0,0 +1,81 @@
+from argparse import ArgumentParser
+
+import numpy as np
+from tqdm import tqdm
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import midi_to_events
+from anticipation.sample import ContextWindow
+from anticipation.tokenize import extract_random, extract_spans
+
+
+def markov_window(tokens, size=1017):
+    """ the original Markov window: the most recent context (with time relativized) and its time offset """
+    history = tokens.copy()
+    lookback = max(len(tokens) - size, 0)
+    history = history[lookback:] # Markov window
+    offset = ops.min_time(history, seconds=False)
+    history[::3] = [tok - offset for tok in history[::3]] # relativize time in the history buffer
+
+    return history, offset
+
+
+def sequences(events):
+    """ token sequences that exercise the window: padding, anticipated controls, separators """
+    end_time = ops.max_time(events, seconds=False)
+    yield events
+    yield ops.pad(events, end_time)
+
+    for extract in [lambda e: extract_spans(e, .05), lambda e: extract_random(e, 5)]:
+        remaining, controls = extract(events)
+        interleaved, _ = ops.anticipate(ops.pad(remaining, end_time), controls)
+        yield interleaved
+
+    # several (clipped) tracks joined by separators
+    joined = []
+    for start in range(0, end_time, 20*TIME_RESOLUTION):
+        clip = ops.clip(events, start, start + 10*TIME_RESOLUTION, seconds=False)
+        joined.extend([SEPARATOR, SEPARATOR, SEPARATOR] + ops.translate(clip, -start))
+    yield joined
+
+
+def check(tokens, size, rng):
+    """ grow the sequence a few events at a time, comparing the windows after each update """
+    context = ContextWindow(size=size)
+    length = 0
+    while length < len(tokens):
+        if length > 0 and rng.random() < .02:
+            length = max(0, length - 3*int(rng.integers(1, 16))) # the sequence was replaced by a shorter one
+        else:
+            length = min(len(tokens), length + 3*int(rng.integers(1, 8)))
+
+        history, offset = context.update(tokens[:length]).window()
+        expected, expected_offset = markov_window(tokens[:length], size)
+        assert offset == expected_offset, (length, offset, expected_offset)
+        assert history.tolist() == expected, length
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    np.random.seed(args.seed)
+
+    for filename in tqdm(args.filename):
+        events = midi_to_events(filename)
+        for tokens in sequences(events):
+            for size in args.size:
+                check(tokens, size, rng)
+
+    print('ContextWindow check passed')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check ContextWindow against the original Markov window')
+    parser.add_argument('filename', nargs='*', default=['examples/strawberry.mid'],
+            help='MIDI files to build token sequences from')
+    parser.add_argument('--size', type=int, nargs='+', default=[1017, 30, 3],
+            help='window sizes (in tokens)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='rng seed')
+    main(parser.parse_args())
@@ -0,0 +1,153 @@
+import os
+from argparse import ArgumentParser
+from glob import glob
+
+import numpy as np
+from tqdm import tqdm
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import compound_to_events, events_to_compound, midi_to_compound
+from anticipation.dataset import compound_sources, read_compound
+from anticipation.tokenize import extract_random, extract_spans
+
+
+def reference_compound_to_events(tokens, stats=False):
+    """ the original list-based compound_to_events """
+    assert len(tokens) % 5 == 0
+    tokens = tokens.copy()
+
+    # remove velocities
+    del tokens[4::5]
+
+    # combine (note, instrument)
+    assert all(-1 <= tok < 2**7 for tok in tokens[2::4])
+    assert all(-1 <= tok < 129 for tok in tokens[3::4])
+    tokens[2::4] = [SEPARATOR if note == -1 else MAX_PITCH*instr + note
+                    for note, instr in zip(tokens[2::4],tokens[3::4])]
+    tokens[2::4] = [NOTE_OFFSET + tok for tok in tokens[2::4]]
+    del tokens[3::4]
+
+    # max duration cutoff and set unknown durations to 250ms
+    truncations = sum([1 for tok in tokens[1::3] if tok >= MAX_DUR])
+    tokens[1::3] = [TIME_RESOLUTION//4 if tok == -1 else min(tok, MAX_DUR-1)
+                    for tok in tokens[1::3]]
+    tokens[1::3] = [DUR_OFFSET + tok for tok in tokens[1::3]]
+
+    assert min(tokens[0::3]) >= 0
+    tokens[0::3] = [TIME_OFFSET + tok for tok in tokens[0::3]]
+
+    assert len(tokens) % 3 == 0
+
+    if stats:
+        return tokens, truncations
+
+    return tokens
+
+
+def reference_events_to_compound(tokens, debug=False):
+    """ the original list-based events_to_compound """
+    tokens = ops.unpad(tokens)
+
+    # move all tokens to zero-offset for synthesis
+    tokens = [tok - CONTROL_OFFSET if tok >= CONTROL_OFFSET and tok != SEPARATOR else tok
+              for tok in tokens]
+
+    # remove type offsets
+    tokens[0::3] = [tok - TIME_OFFSET if tok != SEPARATOR else tok for tok in tokens[0::3]]
+    tokens[1::3] = [tok - DUR_OFFSET if tok != SEPARATOR else tok for tok in tokens[1::3]]
+    tokens[2::3] = [tok - NOTE_OFFSET if tok != SEPARATOR else tok for tok in tokens[2::3]]
+
+    offset = 0 # add max time from previous track for synthesis
+    track_max = 0 # keep track of max time in track
+    for j, (time,dur,note) in enumerate(zip(tokens[0::3],tokens[1::3],tokens[2::3])):
+        if note == SEPARATOR:
+            offset += track_max
+            track_max = 0
+        else:
+            track_max = max(track_max, time+dur)
+            tokens[3*j] += offset
+
+    # strip sequence separators
+    assert len([tok for tok in tokens if tok == SEPARATOR]) % 3 == 0
+    tokens = [tok for tok in tokens if tok != SEPARATOR]
+
+    assert len(tokens) % 3 == 0
+    out = 5*(len(tokens)//3)*[0]
+    out[0::5] = tokens[0::3]
+    out[1::5] = tokens[1::3]
+    out[2::5] = [tok - (2**7)*(tok//2**7) for tok in tokens[2::3]]
+    out[3::5] = [tok//2**7 for tok in tokens[2::3]]
+    out[4::5] = (len(tokens)//3)*[72] # default velocity
+
+    assert max(out[1::5]) < MAX_DUR
+    assert max(out[2::5]) < MAX_PITCH
+    assert max(out[3::5]) < MAX_INSTR
+    assert all(tok >= 0 for tok in out)
+
+    return out
+
+
+def sequences(events):
+    """ event sequences that exercise events_to_compound: padding, controls, separators """
+    end_time = ops.max_time(events, seconds=False)
+    yield events
+    yield ops.pad(events, end_time)
+
+    for extract in [lambda e: extract_spans(e, .05), lambda e: extract_random(e, 5)]:
+        interleaved, _ = ops.anticipate(*extract(events))
+        yield interleaved
+
+    # a training-style sequence: several (clipped) tracks joined by separators
+    joined = []
+    for start in range(0, end_time, 20*TIME_RESOLUTION):
+        clip = ops.clip(events, start, start + 10*TIME_RESOLUTION, seconds=False)
+        joined.extend([SEPARATOR, SEPARATOR, SEPARATOR] + ops.translate(clip, -start))
+    yield joined
+
+
+def main(args):
+    np.random.seed(args.seed)
+
+    tracks = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            tracks.extend(glob(path + '/**/*.mid', recursive=True) + glob(path + '/**/*.midi', recursive=True))
+        elif path.endswith('.mid') or path.endswith('.midi'):
+            tracks.append(path)
+        else:
+            tracks.extend(compound_sources([path]))
+
+    tracks = tracks[::args.subsample]
+    print(f'Checking conversions on {len(tracks)} tracks')
+
+    for track in tqdm(tracks):
+        if isinstance(track, str) and (track.endswith('.mid') or track.endswith('.midi')):
+            compound_tokens = midi_to_compound(track)
+        else:
+            _, compound_tokens = read_compound(track)
+
+        if len(compound_tokens) == 0:
+            continue
+
+        expected = reference_compound_to_events(compound_tokens, stats=True)
+        assert compound_to_events(compound_tokens, stats=True) == expected, track
+        assert compound_to_events(np.array(compound_tokens), stats=True) == expected, track
+
+        events, _ = expected
+        for seq in sequences(events):
+            assert events_to_compound(seq) == reference_events_to_compound(seq), track
+
+    print('Conversion parity check passed')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check the vectorized conversions against the original implementations')
+    parser.add_argument('paths', nargs='*', default=['examples/strawberry.mid'],
+            help='MIDI files, directories of MIDI files, or compound files (text or shards)')
+    parser.add_argument('-s', '--subsample', type=int, default=1,
+            help='check every k-th track')
+    parser.add_argument('--seed', type=int, default=0,
+            help='rng seed for the augmentations')
+    main(parser.parse_args())
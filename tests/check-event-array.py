@@ -0,0 +1,101 @@
+from argparse import ArgumentParser
+
+import numpy as np
+from tqdm import tqdm
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import midi_to_events
+from anticipation.tokenize import extract_random, extract_spans
+
+
+def sequences(events):
+    """ token sequences that exercise the ops: padding, controls, separators """
+    end_time = ops.max_time(events, seconds=False)
+    yield events
+    yield ops.pad(events, end_time)
+
+    for extract in [lambda e: extract_spans(e, .05), lambda e: extract_random(e, 5)]:
+        remaining, controls = extract(events)
+        yield controls
+        interleaved, _ = ops.anticipate(ops.pad(remaining, end_time), controls)
+        yield interleaved
+
+    # several (clipped) tracks joined by separators
+    joined = []
+    for start in range(0, end_time, 20*TIME_RESOLUTION):
+        clip = ops.clip(events, start, start + 10*TIME_RESOLUTION, seconds=False)
+        joined.extend([SEPARATOR, SEPARATOR, SEPARATOR] + ops.translate(clip, -start))
+    yield joined
+
+
+def check(tokens, rng):
+    array = ops.EventArray(tokens)
+    assert array.tolist() == tokens
+    assert ops.EventArray(array.tokens) == array
+
+    end_time = ops.max_time(tokens, seconds=False)
+    for _ in range(5):
+        start, end = sorted(rng.integers(0, end_time+1, 2).tolist())
+        for clip_duration in [True, False]:
+            assert array.clip(start, end, clip_duration, seconds=False).tolist() == \
+                    ops.clip(tokens, start, end, clip_duration, seconds=False)
+            assert array.clip(start/TIME_RESOLUTION, end/TIME_RESOLUTION, clip_duration).tolist() == \
+                    ops.clip(tokens, start/TIME_RESOLUTION, end/TIME_RESOLUTION, clip_duration)
+        assert array.mask(start/TIME_RESOLUTION, end/TIME_RESOLUTION).tolist() == \
+                ops.mask(tokens, start/TIME_RESOLUTION, end/TIME_RESOLUTION)
+
+    events, controls = array.split()
+    assert (events.tolist(), controls.tolist()) == ops.split(tokens)
+    assert array.unpad().tolist() == ops.unpad(tokens)
+
+    for seconds in [True, False]:
+        assert array.min_time(seconds) == ops.min_time(tokens, seconds)
+        assert array.max_time(seconds) == ops.max_time(tokens, seconds)
+        for instr in ops.get_instruments(tokens):
+            assert array.min_time(seconds, instr) == ops.min_time(tokens, seconds, instr)
+            assert array.max_time(seconds, instr) == ops.max_time(tokens, seconds, instr)
+
+    instruments = ops.get_instruments(tokens)
+    assert list(array.get_instruments().items()) == list(instruments.items())
+
+    min_time = ops.min_time(tokens, seconds=False)
+    for dt in [0, TIME_RESOLUTION, -min_time]:
+        assert array.translate(dt).tolist() == ops.translate(tokens, dt)
+    assert array.translate(1.5, seconds=True).tolist() == ops.translate(tokens, 1.5, seconds=True)
+
+    # sort and pad apply to events (or controls) only
+    for part in [events, controls]:
+        shuffled = part.tokens[rng.permutation(len(part))]
+        assert ops.EventArray(shuffled).sort().tolist() == ops.sort(shuffled.reshape(-1).tolist())
+
+    if len(controls) == 0 and SEPARATOR not in tokens[2::3]:
+        for end_time in [None, ops.max_time(tokens, seconds=False) + 5*TIME_RESOLUTION]:
+            for density in [TIME_RESOLUTION, 7]:
+                assert array.pad(end_time, density).tolist() == ops.pad(tokens, end_time, density)
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    np.random.seed(args.seed)
+
+    for filename in tqdm(args.filename):
+        events = midi_to_events(filename)
+        for tokens in sequences(events):
+            check(tokens, rng)
+
+        # short and empty sequences
+        for length in [0, 1, 2, 10]:
+            check(events[:3*length], rng)
+
+    print('EventArray parity check passed')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check EventArray against the list-based ops')
+    parser.add_argument('filename', nargs='*', default=['examples/strawberry.mid'],
+            help='MIDI files to build token sequences from')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='rng seed')
+    main(parser.parse_args())
@@ -1,18 +1,19 @@
 from argparse import ArgumentParser
 from tqdm import tqdm
 
+from anticipation import dataset
 from anticipation.vocab import *
 from anticipation.ops import get_instruments
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='inspect a MIDI dataset')
     parser.add_argument('filename',
-        help='file containing a tokenized MIDI dataset')
+        help='file containing a tokenized MIDI dataset (text or binary)')
     args = parser.parse_args()
 
-    with open(args.filename, 'r') as f:
-        for line in tqdm(list(f)):
-            tokens = [int(token) for token in line.split()]
+    with dataset.load(args.filename) as data:
+        for record in tqdm(data):
+            tokens = record.tolist()
             tokens = tokens[1:] # strip control codes
             assert(len([tok for tok in tokens if tok == SEPARATOR]) % 3 == 0)
 
@@ -0,0 +1,70 @@
+import os
+import time
+from argparse import ArgumentParser
+from glob import glob
+
+from tqdm import tqdm
+
+from anticipation import smf
+from anticipation.convert import midi_to_compound, midi_to_interarrival
+
+
+def convert(filename, fast, interarrival=False):
+    """ tokens (or the exception raised) and the conversion time """
+    t0 = time.time()
+    try:
+        if interarrival:
+            tokens = midi_to_interarrival(filename, stats=True, fast=fast)
+        else:
+            tokens = midi_to_compound(filename, fast=fast)
+    except Exception as e:
+        tokens = type(e)
+
+    return tokens, time.time() - t0
+
+
+def main(args):
+    filenames = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            filenames.extend(glob(path + '/**/*.mid', recursive=True) + glob(path + '/**/*.midi', recursive=True))
+        else:
+            filenames.append(path)
+
+    filenames = filenames[::args.subsample]
+    print(f'Checking the fast MIDI reader on {len(filenames)} files')
+
+    mido_time = fast_time = 0
+    fallbacks = failures = 0
+    for filename in tqdm(filenames):
+        expected, elapsed = convert(filename, False, args.interarrival)
+        mido_time += elapsed
+
+        tokens, elapsed = convert(filename, True, args.interarrival)
+        fast_time += elapsed
+
+        assert tokens == expected, filename
+        if isinstance(expected, type):
+            failures += 1
+
+        try:
+            smf.read(filename)
+        except smf.SMFError:
+            fallbacks += 1
+
+    print('Fast MIDI reader parity check passed')
+    print(f'  => {failures} files are rejected by both readers')
+    print(f'  => {fallbacks} files fell back to mido')
+    print(f'  => mido: {len(filenames)/mido_time:.1f} files/s')
+    print(f'  => fast: {len(filenames)/fast_time:.1f} files/s ({mido_time/fast_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check that the fast MIDI reader matches the mido path of the converters')
+    parser.add_argument('paths', nargs='*', default=['examples/strawberry.mid'],
+            help='MIDI files or directories of MIDI files')
+    parser.add_argument('-s', '--subsample', type=int, default=1,
+            help='check every k-th file')
+    parser.add_argument('-i', '--interarrival', action='store_true',
+            help='check the interarrival tokenization (default: compound)')
+    main(parser.parse_args())
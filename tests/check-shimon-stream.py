@@ -0,0 +1,91 @@
+from argparse import ArgumentParser
+from functools import partial
+from itertools import groupby
+
+import numpy as np
+from tqdm import tqdm
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.convert import midi_to_events
+
+from shimon_filter import filter_notes, octave_fold, expand_tremolo, nudge_runs, stagger_chords, NoteStream
+
+
+def to_notes(events):
+    """ (t, dur, pitch, instrument) notes of a sequence of events, in time order (see jam_server.decode_events) """
+    notes = []
+    for time, dur, note in zip(events[0::3], events[1::3], events[2::3]):
+        instr, pitch = divmod(note - NOTE_OFFSET, MAX_PITCH)
+        notes.append(((time - TIME_OFFSET)/TIME_RESOLUTION, max(.05, (dur - DUR_OFFSET)/TIME_RESOLUTION), pitch, instr))
+
+    return sorted(notes, key=lambda note: note[0])
+
+
+def synthetic(size, rng, rate=8):
+    """ random notes, about rate onsets per second, with chords and many long notes """
+    times = np.sort(rng.integers(0, int(TIME_RESOLUTION*size/rate), size))
+    durs = rng.choice([rng.integers(1, TIME_RESOLUTION), rng.integers(TIME_RESOLUTION, 4*TIME_RESOLUTION)], size)
+    pitches = rng.integers(36, 100, size)
+    return [(t/TIME_RESOLUTION, max(.05, d/TIME_RESOLUTION), int(p), 0) for t, d, p in zip(times, durs, pitches)]
+
+
+def check(notes, stages):
+    """ stream the notes one onset at a time and compare with the pipeline over the whole window """
+    expand, arrange = stages[:2], stages[2:]
+    expected = notes
+    for stage in stages:
+        expected = stage(expected)
+
+    stream = NoteStream(lambda notes: apply(expand, notes), lambda notes: apply(arrange, notes))
+    streamed = []
+    for t, onset in groupby(notes, key=lambda note: note[0]):
+        streamed.extend(stream.add(t, list(onset)))
+    streamed.extend(stream.flush())
+
+    assert streamed == expected, (len(streamed), len(expected))
+    return sum(1 for note in notes if note[1] > stages[1].keywords['max_dur_s'])
+
+
+def apply(stages, notes):
+    for stage in stages:
+        notes = stage(notes)
+    return notes
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    stages = [octave_fold,
+              partial(expand_tremolo, max_dur_s=args.max_note_dur),
+              stagger_chords,
+              nudge_runs,
+              filter_notes]
+
+    long_notes = 0
+    for filename in tqdm(args.filename):
+        events = midi_to_events(filename)
+        end_time = ops.max_time(events, seconds=False)
+        for start in range(0, end_time, args.window*TIME_RESOLUTION):
+            window = ops.clip(events, start, start + args.window*TIME_RESOLUTION, clip_duration=False, seconds=False)
+            long_notes += check(to_notes(window), stages)
+
+    for _ in tqdm(range(args.trials)):
+        long_notes += check(synthetic(int(rng.integers(1, 200)), rng), stages)
+
+    print(f'Streamed Shimon pipeline matches the whole-window pipeline ({long_notes} long notes)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='check the streamed Shimon pipeline against the whole-window pipeline')
+    parser.add_argument('filename', nargs='*', default=['examples/strawberry.mid'],
+            help='MIDI files to build windows of notes from')
+    parser.add_argument('--window', type=int, default=10,
+            help='window length (in seconds)')
+    parser.add_argument('--max-note-dur', type=float, default=1.0,
+            help='notes longer than this (in seconds) are expanded into tremolos')
+    parser.add_argument('-n', '--trials', type=int, default=200,
+            help='number of random windows')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='rng seed')
+    main(parser.parse_args())
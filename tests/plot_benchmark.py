@@ -1,14 +1,15 @@
+import json
 import argparse
 import pickle
 import matplotlib.pyplot as plt
 
-def main(stats_file):
+def plot_stats(stats_file):
     with open(stats_file, 'rb') as file:
         stats = pickle.load(file)
 
     # The imported stats is a list of dicts. Each dict corresponds to a generated sequence.
     # The keys of a dict are (num_instr, interval) tuples. The values of the dict
-    # are lists of times taken to generate each interval. 
+    # are lists of times taken to generate each interval.
 
     times_by_num_instr = {}
     interval = None
@@ -23,7 +24,7 @@ def main(stats_file):
             if num_instr in times_by_num_instr:
                 times_by_num_instr[num_instr].extend(value)
             else:
-                times_by_num_instr[num_instr] = value 
+                times_by_num_instr[num_instr] = value
 
     means = []
     stds = []
@@ -38,11 +39,83 @@ def main(stats_file):
     plt.xlabel('Number of Instruments')
     plt.ylabel('Time (s)')
     plt.title(f'Generation Time of {interval}s Intervals by Number of Instruments')
-    plt.legend() 
+    plt.legend()
     plt.show()
 
+def load_runs(results_files):
+    """ (label, device, results) for each device of each benchmark run (see benchmark.py) """
+    runs = []
+    for filename in results_files:
+        with open(filename) as file:
+            results = json.load(file)
+
+        env = results['environment']
+        for device, device_results in results['devices'].items():
+            label = f"{filename} ({device}, {env['commit'][:8] or env['timestamp']})"
+            runs.append((label, device, device_results))
+
+    return runs
+
+def compare(results_files, baseline=0):
+    runs = load_runs(results_files)
+
+    # summary table, relative to the baseline run
+    _, _, base = runs[baseline]
+    base_throughput = {name: base[name]['throughput']['median'] for name in ['generate', 'generate_ar']}
+    print(f"{'run':60s} {'generate (ev/s)':>18s} {'generate_ar (ev/s)':>20s} {'step @ max fill (ms)':>22s}")
+    for label, _, results in runs:
+        columns = []
+        for name in ['generate', 'generate_ar']:
+            throughput = results[name]['throughput']['median']
+            ratio = f' ({throughput/base_throughput[name]:.2f}x)' if base_throughput[name] > 0 else ''
+            columns.append(f'{throughput:.1f}{ratio}')
+        step = 1000*results['step'][-1]['step']['median']
+        print(f'{label:60s} {columns[0]:>18s} {columns[1]:>20s} {step:22.2f}')
+
+    fig, (latency, passes, throughput) = plt.subplots(1, 3, figsize=(18, 5))
+    for label, _, results in runs:
+        fills = [level['fill'] for level in results['step']]
+        latency.errorbar(fills, [1000*level['step']['median'] for level in results['step']],
+                         yerr=[1000*level['step']['std'] for level in results['step']], fmt='o-', label=label)
+        passes.plot(fills, [1000*level['prefill']['median'] for level in results['step']], 'o-', label=f'{label} prefill')
+        if all(level['decode'] for level in results['step']):
+            passes.plot(fills, [1000*level['decode']['median'] for level in results['step']], 'x--', label=f'{label} decode')
+
+    latency.set_xlabel('Context fill (events)')
+    latency.set_ylabel('Time (ms)')
+    latency.set_title('add_token step latency')
+    latency.legend(fontsize='small')
+
+    passes.set_xlabel('Context fill (events)')
+    passes.set_ylabel('Time (ms)')
+    passes.set_title('Prefill vs decode')
+    passes.legend(fontsize='small')
+
+    width = 0.8 / len(runs)
+    for k, (label, _, results) in enumerate(runs):
+        medians = [results[name]['throughput']['median'] for name in ['generate', 'generate_ar']]
+        stds = [results[name]['throughput']['std'] for name in ['generate', 'generate_ar']]
+        throughput.bar([x + k*width for x in range(2)], medians, width, yerr=stds, label=label)
+    throughput.set_xticks([x + width*(len(runs)-1)/2 for x in range(2)])
+    throughput.set_xticklabels(['generate', 'generate_ar'])
+    throughput.set_ylabel('Events/s')
+    throughput.set_title('Generation throughput')
+    throughput.legend(fontsize='small')
+
+    plt.tight_layout()
+    plt.show()
+
+def main(args):
+    if args.files[0].endswith('.pickle'):
+        plot_stats(args.files[0])
+    else:
+        compare(args.files, args.baseline)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Plot benchmark data')
-    parser.add_argument('stats_file', type=str, help='Path to the stats file')
+    parser.add_argument('files', type=str, nargs='+',
+                        help='Benchmark results (JSON) to compare, or a stats file (.pickle) from the old benchmark')
+    parser.add_argument('-b', '--baseline', type=int, default=0,
+                        help='Index of the run to compare the others against')
     args = parser.parse_args()
-    main(args.stats_file)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,35 @@
+from argparse import ArgumentParser
+
+import numpy as np
+from tqdm import tqdm
+
+from anticipation import dataset
+
+
+def main(args):
+    inputs = [dataset.BinaryDataset(filename) for filename in args.inputs]
+    assert len(set(data.length for data in inputs)) == 1, 'record lengths must agree'
+    assert len(set(data.dtype for data in inputs)) == 1, 'token types must agree'
+
+    # (file, record) index of every record, in output order
+    index = np.concatenate([np.stack([np.full(len(data), k), np.arange(len(data))], axis=1)
+                            for k, data in enumerate(inputs)])
+    if args.shuffle:
+        index = index[np.random.default_rng(args.seed).permutation(len(index))]
+
+    print(f'Writing {len(index)} records to {args.output}{" (shuffled)" if args.shuffle else ""}')
+    with dataset.BinaryWriter(args.output, inputs[0].length, inputs[0].dtype) as outfile:
+        for k, i in tqdm(index):
+            outfile.write(inputs[k][i])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='concatenate (and shuffle) binary tokenized datasets')
+    parser.add_argument('output', help='binary tokenized dataset to write')
+    parser.add_argument('inputs', nargs='+', help='binary tokenized datasets to concatenate')
+    parser.add_argument('-s', '--shuffle', action='store_true',
+            help='shuffle the records')
+    parser.add_argument('--seed', type=int, default=0,
+            help='rng seed for the shuffle')
+
+    main(parser.parse_args())
@@ -1,22 +1,35 @@
+import os
 import traceback
 from argparse import ArgumentParser
 from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from glob import glob
 
+import numpy as np
 from tqdm import tqdm
 
 from anticipation.convert import midi_to_compound
 from anticipation.config import PREPROC_WORKERS
+from anticipation.dataset import CompoundShardWriter, COMPOUND_SHARD, EVENTS_SHARD, INTERARRIVAL_SHARD, file_hash, open_shard, tokens_hash
+from anticipation.tokenize import preprocess, settings_version
 
 
-def convert_midi(filename, debug=False):
+def compound_midi(filename, debug=False, fast=True):
     try:
-        tokens = midi_to_compound(filename, debug=debug)
+        tokens = midi_to_compound(filename, debug=debug, fast=fast)
     except Exception:
         if debug:
             print('Failed to process: ', filename)
             print(traceback.format_exc())
 
+        return None
+
+    return tokens
+
+
+def convert_midi(filename, debug=False, fast=True):
+    tokens = compound_midi(filename, debug, fast)
+    if tokens is None:
         return 1
 
     with open(f"{filename}.compound.txt", 'w') as f:
@@ -25,13 +38,92 @@ def convert_midi(filename, debug=False):
     return 0
 
 
+def cached_encodings(filename, key):
+    """ the encodings of a MIDI file in the shards of a previous run (None if they aren't there) """
+    directory = os.path.dirname(filename)
+    shards = [os.path.join(directory, name) for name in [COMPOUND_SHARD, EVENTS_SHARD, INTERARRIVAL_SHARD]]
+    if not all(os.path.exists(shard) for shard in shards):
+        return None
+
+    compound, events, interarrival = [open_shard(shard) for shard in shards]
+    if any(shard.version != settings_version() or key not in shard for shard in [compound, events, interarrival]):
+        return None
+
+    status = events.info(key)['status']
+    return dict(compound=np.array(compound[key]), events=np.array(events[key]) if status == 0 else None,
+                interarrival=np.array(interarrival[key]), status=status,
+                truncations=events.info(key)['truncations'],
+                interarrival_truncations=interarrival.info(key)['truncations'])
+
+
+def shard_midi(filename, debug=False, fast=True, reuse=True):
+    key = file_hash(filename)
+    if reuse:
+        encodings = cached_encodings(filename, key)
+        if encodings is not None:
+            return key, encodings, True
+
+    try:
+        encodings = preprocess(filename, fast)
+    except Exception:
+        if debug:
+            print('Failed to process: ', filename)
+            print(traceback.format_exc())
+
+        return key, None, False
+
+    return key, encodings, False
+
+
 def main(args):
     filenames = glob(args.dir + '/**/*.mid', recursive=True) \
             + glob(args.dir + '/**/*.midi', recursive=True)
 
+    # a fixed order, independent of the filesystem: the tracks of each shard are in the
+    # (sorted) order of their compound text files, the order that tokenize-lakh reads them
+    filenames = sorted(filenames, key=lambda filename: f'{filename}.compound.txt')
+
     print(f'Preprocessing {len(filenames)} files with {PREPROC_WORKERS} workers')
     with ProcessPoolExecutor(max_workers=PREPROC_WORKERS) as executor:
-        results = list(tqdm(executor.map(convert_midi, filenames), desc='Preprocess', total=len(filenames)))
+        if args.shard:
+            # one shard per encoding for each directory of MIDI files
+            shards = {}
+            results = []
+            filtered = reused = 0
+            version = settings_version()
+            outputs = executor.map(partial(shard_midi, fast=not args.mido, reuse=not args.force), filenames, chunksize=64)
+            for filename, (key, encodings, cached) in tqdm(zip(filenames, outputs), desc='Preprocess', total=len(filenames)):
+                results.append(encodings is None)
+                reused += cached
+                if encodings is None:
+                    continue
+
+                directory = os.path.dirname(filename)
+                if directory not in shards:
+                    shards[directory] = [
+                        CompoundShardWriter(os.path.join(directory, COMPOUND_SHARD), 'compound', version),
+                        CompoundShardWriter(os.path.join(directory, EVENTS_SHARD), 'events', version),
+                        CompoundShardWriter(os.path.join(directory, INTERARRIVAL_SHARD), 'interarrival', version)]
+
+                compound, events, interarrival = shards[directory]
+                status = encodings['status']
+                filtered += status > 0
+                # the key of the track for tokenization (see dataset.track_key), as if read from text
+                track_hash = tokens_hash(encodings['compound'])
+                compound.add(key, filename, encodings['compound'], tokens_hash=track_hash)
+                events.add(key, filename, encodings['events'] if encodings['events'] is not None else [],
+                           status=status, truncations=encodings['truncations'], tokens_hash=track_hash)
+                interarrival.add(key, filename, encodings['interarrival'], status=status,
+                                 truncations=encodings['interarrival_truncations'], tokens_hash=track_hash)
+
+            for writers in shards.values():
+                for shard in writers:
+                    shard.close()
+
+            print(f'Reused {reused} tracks from the shards of a previous run')
+            print(f'Filtered {filtered} tracks for tokenization (see tokenize.maybe_tokenize)')
+        else:
+            results = list(tqdm(executor.map(partial(convert_midi, fast=not args.mido), filenames), desc='Preprocess', total=len(filenames)))
 
     discards = round(100*sum(results)/float(len(filenames)),2)
     print(f'Successfully processed {len(filenames) - sum(results)} files (discarded {discards}%)')
@@ -39,4 +131,10 @@ def main(args):
 if __name__ == '__main__':
     parser = ArgumentParser(description='prepares a MIDI dataset')
     parser.add_argument('dir', help='directory containing .mid files for training')
+    parser.add_argument('-s', '--shard', action='store_true',
+            help=f'write the encodings of each directory to binary shards ({COMPOUND_SHARD}, {EVENTS_SHARD}, {INTERARRIVAL_SHARD})')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='reprocess every file (by default, --shard reuses tracks from existing shards)')
+    parser.add_argument('--mido', action='store_true',
+            help='read every MIDI file with mido (slower; the fast reader gives the same tokens)')
     main(parser.parse_args())
@@ -1,17 +1,31 @@
 import os
 from argparse import ArgumentParser
-from multiprocessing import Pool, RLock
+from multiprocessing import Pool
 from glob import glob
 
+import numpy as np
 from tqdm import tqdm
 
+from anticipation import dataset
 from anticipation.config import *
-from anticipation.tokenize import tokenize, tokenize_ia
+from anticipation.dataset import COMPOUND_SHARD, EVENTS_SHARD, INTERARRIVAL_SHARD, compound_sources
+from anticipation.tokenize import SequencePacker, tokenize_streams
+
+
+def tokenize_chunk(task):
+    split, sources, output, augment, interarrival, cache = task
+    streams, stats = tokenize_streams(sources, output, augment, interarrival, cache)
+    return split, len(sources), output, streams, stats
+
 
 def main(args):
     encoding = 'interarrival' if args.interarrival else 'arrival'
     print('Tokenizing LakhMIDI')
     print(f'  encoding type: {encoding}')
+    print(f'  output format: {"binary" if args.binary else "text"}')
+    print(f'  workers: {args.workers} (chunks of {args.chunk_size} tracks)')
+    if args.cache:
+        print(f'  track cache: {args.cache}')
     print(f'  train split: {[s for s in LAKH_SPLITS if s not in LAKH_VALID + LAKH_TEST]}')
     print(f'  validation split: {LAKH_VALID}')
     print(f'  test split: {LAKH_TEST}')
@@ -24,20 +38,58 @@ def main(args):
     print(f'  min track events = {MIN_TRACK_EVENTS}')
 
     paths = [os.path.join(args.datadir, s) for s in LAKH_SPLITS]
-    files = [glob(f'{p}/*.compound.txt') for p in paths]
-    outputs = [os.path.join(args.datadir, f'tokenized-events-{s}.txt') for s in LAKH_SPLITS]
+    # read the shards written by midi-preprocess.py --shard if there are any:
+    # preferably the preprocessed encoding, otherwise the compound tokens
+    preprocessed = INTERARRIVAL_SHARD if args.interarrival else EVENTS_SHARD
+    files = []
+    for p in paths:
+        shards = [os.path.join(p, shard) for shard in [preprocessed, COMPOUND_SHARD]]
+        shards = [shard for shard in shards if os.path.exists(shard)]
+        files.append(shards[:1] if shards else sorted(glob(f'{p}/*.compound.txt')))
+    extension = 'bin' if args.binary else 'txt'
+    outputs = [os.path.join(args.datadir, f'tokenized-events-{s}.{extension}') for s in LAKH_SPLITS]
 
     # don't augment the valid/test splits
     augment = [1 if s in LAKH_VALID or s in LAKH_TEST else args.augment for s in LAKH_SPLITS]
 
-    # parallel tokenization drops the last chunk of < M tokens
-    # if concerned about waste: process larger groups of datafiles
-    func = tokenize_ia if args.interarrival else tokenize
-    with Pool(processes=PREPROC_WORKERS, initargs=(RLock(),), initializer=tqdm.set_lock) as pool:
-        results = pool.starmap(func, zip(files, outputs, augment, range(len(LAKH_SPLITS))))
+    # split the tracks of each split into chunks, tokenized independently (to separate files):
+    # the token streams of the chunks are packed into the sequences of each split in order,
+    # so the output doesn't depend on the chunk size or the number of workers
+    tasks = []
+    for split, (datafiles, output, k) in enumerate(zip(files, outputs, augment)):
+        sources = compound_sources(datafiles)
+        base, _ = os.path.splitext(output)
+        for i, start in enumerate(range(0, len(sources), args.chunk_size)):
+            chunk_output = f'{base}.{i:05d}.streams'
+            tasks.append((split, sources[start:start+args.chunk_size], chunk_output, k, args.interarrival, args.cache))
+
+    writers = [dataset.writer(output, args.binary) for output in outputs]
+    packers = [SequencePacker(outfile, args.interarrival) for outfile in writers]
+
+    # workers take the next chunk as soon as they finish one; results arrive in order
+    with Pool(processes=args.workers) as pool:
+        results = []
+        with tqdm(desc='Tokenize', total=sum(len(task[1]) for task in tasks)) as progress:
+            for split, count, chunk_output, streams, stats in pool.imap(tokenize_chunk, tasks):
+                if streams:
+                    tokens = np.memmap(chunk_output, dtype=np.int32, mode='r')
+                    offset = 0
+                    for length, z in streams:
+                        packers[split].add(tokens[offset:offset+length], z)
+                        offset += length
+                    del tokens
+
+                os.remove(chunk_output)
+                results.append(stats)
+                progress.update(count)
+
+    for outfile in writers:
+        outfile.close()
 
     seq_count, rest_count, too_short, too_long, too_manyinstr, discarded_seqs, truncations \
             = (sum(x) for x in zip(*results))
+    seq_count = sum(packer.seqcount for packer in packers)
+    discarded_seqs = sum(packer.discarded for packer in packers)
     rest_ratio = round(100*float(rest_count)/(seq_count*M),2)
 
     trunc_type = 'interarrival' if args.interarrival else 'duration'
@@ -63,5 +115,14 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--interarrival',
             action='store_true',
             help='request interarrival-time enocoding (default to arrival-time encoding)')
+    parser.add_argument('-b', '--binary',
+            action='store_true',
+            help='write memory-mappable binary datasets (default to text)')
+    parser.add_argument('-w', '--workers', type=int, default=PREPROC_WORKERS,
+            help='number of worker processes (default to the available cores)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=512,
+            help='number of tracks in each unit of work')
+    parser.add_argument('--cache',
+            help='directory of a cache of tokenized tracks: only tracks missing from the cache are tokenized')
 
     main(parser.parse_args())